@@ -0,0 +1,22 @@
+from datetime import datetime, timedelta
+from typing import Callable
+import pytest
+
+
+
+def write_calendar(filename: str, first_day: datetime, count: int, interval_days: int = 7, summaries=('Biotonne', 'Papiertonne')):
+    # a calendar with count collection days of each summary, every interval_days starting at first_day
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//waste_collection_tests//EN"]
+    for summary in summaries:
+        for idx in range(count):
+            date = first_day + timedelta(days=idx * interval_days)
+            lines += ["BEGIN:VEVENT", "UID:" + summary + "-" + date.strftime("%Y%m%d"), "DTSTART;VALUE=DATE:" + date.strftime("%Y%m%d"), "SUMMARY:" + summary,
+                      "BEGIN:VALARM", "ACTION:DISPLAY", "TRIGGER:-PT12H", "END:VALARM", "END:VEVENT"]
+    lines.append("END:VCALENDAR")
+    with open(filename, 'w', encoding='utf-8', newline='') as file:
+        file.write("\r\n".join(lines) + "\r\n")
+
+
+@pytest.fixture
+def calendar_writer() -> Callable[..., None]:
+    return write_calendar
@@ -0,0 +1,139 @@
+import json
+from datetime import datetime, timedelta
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+from time import time
+from typing import List, Tuple
+import pytest
+from waste_collection import WasteCollectionSchedule, IcsFileCache
+from waste_collection_remote import RemoteSources
+
+
+
+class CalendarHandler(BaseHTTPRequestHandler):
+    """
+    local stand-in of a calendar server: /street.ics supports ETag/If-Modified-Since, /moved.ics redirects to it
+    and /broken.ics fails with 500
+    """
+
+    protocol_version = 'HTTP/1.1'    # keep-alive
+    calendar = b""
+    etag = '"v1"'
+    last_modified = formatdate(0, usegmt=True)
+    connections = 0
+    requests: List[Tuple[str, int, str]] = []   # path, status, conditional headers sent
+
+    def setup(self):
+        super().setup()
+        CalendarHandler.connections += 1
+
+    def do_GET(self):
+        conditional = ",".join(name for name in ('If-None-Match', 'If-Modified-Since') if name in self.headers)
+        if self.path == '/moved.ics':
+            self.__respond(301, conditional, {'Location': '/street.ics'})
+        elif self.path == '/street.ics':
+            if self.headers.get('If-None-Match') == self.etag or ('If-None-Match' not in self.headers and self.headers.get('If-Modified-Since') == self.last_modified):
+                self.__respond(304, conditional, {'ETag': self.etag})
+            else:
+                self.__respond(200, conditional, {'ETag': self.etag, 'Last-Modified': self.last_modified, 'Content-Type': 'text/calendar'}, self.calendar)
+        else:
+            self.__respond(500, conditional)
+
+    def __respond(self, status: int, conditional: str, headers: dict = None, body: bytes = b""):
+        CalendarHandler.requests.append((self.path, status, conditional))
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path, calendar_writer):
+    calendar_writer(str(tmp_path / "street.ics"), datetime.now() + timedelta(days=1), 20)
+    CalendarHandler.calendar = (tmp_path / "street.ics").read_bytes()
+    CalendarHandler.etag = '"v1"'
+    CalendarHandler.last_modified = formatdate(0, usegmt=True)
+    CalendarHandler.connections = 0
+    CalendarHandler.requests = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), CalendarHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:" + str(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def schedule(tmp_path, server):
+    directory = tmp_path / "ics"
+    directory.mkdir()
+    (directory / 'sources.json').write_text(json.dumps({'street': server + "/moved.ics", 'broken': server + "/broken.ics"}))
+    schedule = WasteCollectionSchedule(str(directory), watcher='interval', cache=IcsFileCache(),
+                                       remote=RemoteSources(str(directory / 'sources.json'), str(tmp_path / 'download')))
+    yield schedule
+    schedule.stop()
+
+
+def statuses() -> List[Tuple[str, int]]:
+    return [(path, status) for path, status, _ in CalendarHandler.requests]
+
+
+def test_fetch_follows_redirects_and_backs_off(schedule):
+    street, broken = schedule.remote.sources['street'], schedule.remote.sources['broken']
+    assert statuses() == [('/moved.ics', 301), ('/street.ics', 200), ('/broken.ics', 500)]
+    assert len(schedule.snapshot.events) == 40
+    assert (street.etag, street.last_modified) == (CalendarHandler.etag, CalendarHandler.last_modified)
+    assert broken.failures == 1
+    assert RemoteSources.BACKOFF_BASE_SEC - 10 < broken.next_attempt - time() <= RemoteSources.BACKOFF_BASE_SEC
+
+    # the failed source is not requested within its backoff
+    CalendarHandler.requests.clear()
+    schedule.reload(set())
+    assert ('/broken.ics', 500) not in statuses()
+
+    # the backoff doubles on the next failure
+    broken.next_attempt = 0
+    schedule.reload(set())
+    assert ('/broken.ics', 500) in statuses()
+    assert broken.failures == 2
+    assert RemoteSources.BACKOFF_BASE_SEC < broken.next_attempt - time() <= 2 * RemoteSources.BACKOFF_BASE_SEC
+
+
+def test_unchanged_calendar_is_not_parsed_again(schedule):
+    cache, street = schedule.cache, schedule.remote.sources['street']
+    misses, events = cache.misses, len(schedule.snapshot.events)
+
+    # 304 by ETag
+    CalendarHandler.requests.clear()
+    schedule.reload(set())
+    assert statuses() == [('/moved.ics', 301), ('/street.ics', 304)]
+    assert all('If-None-Match' in conditional for _, _, conditional in CalendarHandler.requests)
+    assert cache.misses == misses
+    assert len(schedule.snapshot.events) == events
+
+    # 304 by If-Modified-Since
+    street.etag = None
+    CalendarHandler.requests.clear()
+    schedule.reload(set())
+    assert CalendarHandler.requests[-1] == ('/street.ics', 304, 'If-Modified-Since')
+    assert cache.misses == misses
+
+    # a modified calendar is fetched and parsed again
+    CalendarHandler.etag = '"v2"'
+    CalendarHandler.last_modified = formatdate(3600, usegmt=True)
+    CalendarHandler.calendar = CalendarHandler.calendar.replace(b"Papiertonne", b"Restmuelltonne")
+    schedule.reload(set())
+    assert cache.misses == misses + 1
+    assert len(schedule.snapshot.series('residual')) == 20
+
+
+def test_single_keep_alive_connection(schedule):
+    for _ in range(3):
+        schedule.reload(set())
+    assert len(CalendarHandler.requests) > 5
+    assert CalendarHandler.connections == 1
@@ -0,0 +1,77 @@
+import os
+import shutil
+from datetime import datetime, timedelta
+from threading import Thread, Lock
+from typing import List
+from waste_collection import WasteCollectionSchedule, IcsFileCache, ScheduleChange
+
+
+
+RELOADS = 100
+READERS = 4
+
+
+def test_concurrent_readers_during_rapid_reloads(tmp_path, calendar_writer):
+    # the readers and a refresher race against reloads toggling a second calendar with earlier collections
+    directory, spare = tmp_path / "ics", tmp_path / "spare"
+    directory.mkdir()
+    spare.mkdir()
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    calendar_writer(str(directory / "a.ics"), today + timedelta(days=3), 50)
+    calendar_writer(str(spare / "b.ics"), today + timedelta(days=1), 30)
+    schedule = WasteCollectionSchedule(str(directory), watcher='interval', cache=IcsFileCache())
+    try:
+        single = len(schedule.snapshot.events)
+        shutil.copy(spare / "b.ics", directory / "b.ics")
+        schedule.reload()
+        expected = {1: single, 2: len(schedule.snapshot.events)}
+        assert expected[2] > expected[1]
+
+        errors: List[str] = []
+        changes: List[ScheduleChange] = []
+        lock = Lock()
+        running = [True]
+
+        def on_change(change: ScheduleChange):
+            with lock:
+                changes.append(change)
+
+        def read():
+            last_generation = -1
+            while running[0]:
+                snapshot = schedule.snapshot
+                if snapshot.generation < last_generation:
+                    errors.append("generation went back")
+                last_generation = snapshot.generation
+                if len(snapshot.timeline) != sum(len(days) for days in snapshot.timeseries.values()):
+                    errors.append("timeline and timeseries differ")
+                if len(snapshot.events) != expected[len(snapshot.scanned_ics_files)]:
+                    errors.append("snapshot mixes the events of different file sets")
+
+        def refresh():
+            while running[0]:
+                schedule.refresh()
+
+        schedule.set_listener(on_change)
+        threads = [Thread(target=read) for _ in range(READERS)] + [Thread(target=refresh)]
+        for thread in threads:
+            thread.start()
+        try:
+            for idx in range(RELOADS):
+                if idx % 2 == 0:
+                    os.remove(directory / "b.ics")
+                else:
+                    shutil.copy(spare / "b.ics", directory / "b.ics")
+                schedule.reload()
+        finally:
+            running[0] = False
+            for thread in threads:
+                thread.join()
+
+        assert sorted(set(errors)) == []
+        generations = [change.snapshot.generation for change in changes]
+        assert generations == sorted(generations), "the changes have been delivered out of order"
+        assert changes[-1].snapshot is schedule.snapshot
+        assert changes[-1].next_dates == schedule.snapshot.next_dates()
+    finally:
+        schedule.stop()
@@ -1,10 +1,25 @@
+import asyncio
 import logging
 import os
-from ics import Calendar
-from threading import Thread
+import hashlib
+import json
+import mmap
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import Executor, ThreadPoolExecutor, Future, BrokenExecutor
+from threading import Thread, Lock, RLock
+from queue import Queue, Empty
 from datetime import datetime, timedelta
-from time import sleep
-from typing import List
+from types import MappingProxyType
+from time import time, perf_counter
+from typing import List, Dict, Set, Optional, Iterator, Tuple, Hashable, Callable, Mapping, Union
+from waste_collection_watcher import create_watcher
+from waste_collection_ics import read_vevents, unescape_text, parse_date, recurrence_rule
+from dateutil.rrule import rrulestr
+from waste_collection_categories import CategoryRegistry
+from waste_collection_remote import RemoteSources
+from waste_collection_metrics import Metrics, ReloadProfile, default_metrics
 
 
 
@@ -33,114 +48,1076 @@ class Date:
 
 
 
+def read_ics_file(filename: str) -> str:
+    ignore_section = False
+    lines = []
+    with open(filename, 'r') as file:
+        for line in file:
+            if line.startswith("BEGIN:VALARM"):
+                ignore_section = True
+            elif line.startswith("END:VALARM"):
+                ignore_section = False
+            elif not ignore_section:
+                lines.append(line)
+    return "".join(lines)
+
+
+def read_events(filename: str, strict: bool = False) -> Iterator[Tuple[datetime, str, str, Optional[str]]]:
+    """
+    yields date, summary, location and the recurrence rule (None for single events) of the file's events.
+    strict: full parse by the ics library (recurrences are not supported). Otherwise the streaming VEVENT reader is used
+    """
+    if strict:
+        from ics import Calendar   # imported on demand, the ics library is slow to import
+        for event in Calendar(read_ics_file(filename)).events:
+            yield day_granularity(event.begin.datetime), event.name, event.location or "", None
+    else:
+        overridden: Dict[str, List[str]] = {}   # uid -> RECURRENCE-IDs of modified instances
+        recurring: List[Tuple[Dict[str, Tuple[str, str]], datetime, str, str]] = []
+        for event in read_vevents(filename, ('DTSTART', 'SUMMARY', 'LOCATION', 'UID', 'RRULE', 'RDATE', 'EXDATE', 'RECURRENCE-ID')):
+            if 'DTSTART' in event:
+                date, summary, location = parse_date(event['DTSTART'][1]), unescape_text(event.get('SUMMARY', ("", ""))[1]), unescape_text(event.get('LOCATION', ("", ""))[1])
+                if 'RECURRENCE-ID' in event:
+                    overridden.setdefault(event.get('UID', ("", ""))[1], []).append(event['RECURRENCE-ID'][1])
+                if 'RRULE' in event or 'RDATE' in event:
+                    recurring.append((event, date, summary, location))
+                else:
+                    yield date, summary, location, None
+        for event, date, summary, location in recurring:
+            # modified instances are excluded from the recurrence set, they are reported as single events
+            for recurrence_id in overridden.get(event.get('UID', ("", ""))[1], []):
+                params, exdates = event.get('EXDATE', ("", ""))
+                event['EXDATE'] = (params, recurrence_id if exdates == "" else exdates + "," + recurrence_id)
+            yield date, summary, location, recurrence_rule(event)
+
+
+
+class InternTable:
+    """
+    stores each distinct string once. Entries are referenced by their index
+    """
+
+    def __init__(self, values: List[str] = None):
+        self.values: List[str] = []
+        self.__index: Dict[str, int] = {}
+        for value in ([] if values is None else values):
+            self.intern(value)
+
+    def intern(self, value: str) -> int:
+        idx = self.__index.get(value)
+        if idx is None:
+            idx = len(self.values)
+            self.values.append(value)
+            self.__index[value] = idx
+        return idx
+
+    def __getitem__(self, idx: int) -> str:
+        return self.values[idx]
+
+    def __len__(self):
+        return len(self.values)
+
+
+class EventStore:
+    """
+    columnar store of collection events. Each event costs a date ordinal (int32), a category id (byte) and
+    references (uint32) into the interned summary, location and source file tables, instead of a datetime object
+    """
+
+    def __init__(self):
+        self.days = array('i')             # date ordinals
+        self.category_ids = bytearray()
+        self.summary_ids = array('I')
+        self.location_ids = array('I')
+        self.source_ids = array('I')
+        self.categories = InternTable()
+        self.summaries = InternTable()
+        self.locations = InternTable()
+        self.sources = InternTable()
+
+    def __len__(self):
+        return len(self.days)
+
+    def add(self, ordinal: int, category: str, summary: str = "", location: str = "", source: str = ""):
+        category_id = self.categories.intern(category)
+        if category_id > 255:
+            raise ValueError("too many categories")
+        self.days.append(ordinal)
+        self.category_ids.append(category_id)
+        self.summary_ids.append(self.summaries.intern(summary))
+        self.location_ids.append(self.locations.intern(location))
+        self.source_ids.append(self.sources.intern(source))
+
+    def extend(self, other: 'EventStore', source: Optional[str] = None):
+        # appends the events of the other store. If a source is given, it replaces the events' source
+        category_map = bytes(self.categories.intern(category) for category in other.categories.values)
+        summary_map = [self.summaries.intern(summary) for summary in other.summaries.values]
+        location_map = [self.locations.intern(location) for location in other.locations.values]
+        self.days.extend(other.days)
+        self.category_ids.extend(other.category_ids.translate(category_map.ljust(256, b"\0")))
+        self.summary_ids.extend(array('I', [summary_map[idx] for idx in other.summary_ids]))
+        self.location_ids.extend(array('I', [location_map[idx] for idx in other.location_ids]))
+        if source is None:
+            source_map = [self.sources.intern(other_source) for other_source in other.sources.values]
+            self.source_ids.extend(array('I', [source_map[idx] for idx in other.source_ids]))
+        else:
+            self.source_ids.extend(array('I', [self.sources.intern(source)]) * len(other))
+
+    def sorted_by_day(self, category_order: List[str] = None) -> 'EventStore':
+        # events of the same day are ordered by the given category order (unlisted categories last), otherwise they keep their order
+        if category_order is None:
+            order = sorted(range(len(self.days)), key=self.days.__getitem__)
+        else:
+            rank = {category: idx for idx, category in enumerate(category_order)}
+            ranks = bytes(min(rank.get(category, 255), 255) for category in self.categories.values)
+            keys = [(ordinal << 8) | ranks[category_id] for ordinal, category_id in zip(self.days, self.category_ids)]
+            order = sorted(range(len(keys)), key=keys.__getitem__)
+        store = EventStore()
+        store.categories, store.summaries, store.locations, store.sources = self.categories, self.summaries, self.locations, self.sources
+        store.days = array('i', [self.days[idx] for idx in order])
+        store.category_ids = bytearray(self.category_ids[idx] for idx in order)
+        store.summary_ids = array('I', [self.summary_ids[idx] for idx in order])
+        store.location_ids = array('I', [self.location_ids[idx] for idx in order])
+        store.source_ids = array('I', [self.source_ids[idx] for idx in order])
+        return store
+
+    def series(self) -> Dict[str, array]:
+        # category name -> date ordinals (in store order)
+        series = [array('i') for _ in range(len(self.categories))]
+        for ordinal, category_id in zip(self.days, self.category_ids):
+            series[category_id].append(ordinal)
+        return dict(zip(self.categories.values, series))
+
+    def event(self, idx: int) -> Tuple[datetime, str, str, str, str]:
+        # date, category, summary, location and source file of the event
+        return (datetime.fromordinal(self.days[idx]), self.categories[self.category_ids[idx]], self.summaries[self.summary_ids[idx]],
+                self.locations[self.location_ids[idx]], self.sources[self.source_ids[idx]])
+
+    def between(self, start: datetime, end: datetime) -> List[Tuple[datetime, str, str, str, str]]:
+        # events within [start, end] (day granularity). Requires a store sorted by day
+        return [self.event(idx) for idx in range(bisect_left(self.days, start.toordinal()), bisect_right(self.days, end.toordinal()))]
+
+    def first(self, start_ordinal: int, count: int) -> List[Tuple[datetime, str, str, str, str]]:
+        # the first count events on or after the given day. Requires a store sorted by day
+        start_idx = bisect_left(self.days, start_ordinal)
+        return [self.event(idx) for idx in range(start_idx, min(start_idx + max(count, 0), len(self.days)))]
+
+
+
+class ParsedIcsFile:
+
+    def __init__(self, events: EventStore, recurrences: List[Tuple[str, str, str, str]] = None):
+        self.events = events    # single events
+        self.recurrences = [] if recurrences is None else recurrences   # (category, recurrence rule, summary, location) of recurring events
+        self.parse_sec = 0.0      # duration of the parse (not persisted)
+        self.classify_sec = 0.0   # share of the parse spent on classifying the summaries
+
+    def expand(self, window_start: datetime, window_end: datetime) -> EventStore:
+        """
+        returns the occurrences of the recurring events within the window
+        """
+        occurrences = EventStore()
+        for category, rule, summary, location in self.recurrences:
+            for occurrence in rrulestr(rule, forceset=True).between(window_start, window_end, inc=True):
+                occurrences.add(occurrence.toordinal(), category, summary, location)
+        return occurrences
+
+
+def parse_ics_file(filename: str, strict: bool = False, categories: CategoryRegistry = None) -> ParsedIcsFile:
+    start = perf_counter()
+    classify_sec = 0.0
+    categories = CategoryRegistry() if categories is None else categories
+    events = EventStore()
+    recurrences = []
+    num_unclassified = 0
+    for date, topic, location, rule in read_events(filename, strict):
+        classify_start = perf_counter()
+        category = categories.classify(topic)
+        classify_sec += perf_counter() - classify_start
+        if category is None:
+            num_unclassified += 1
+        elif rule is None:
+            events.add(date.toordinal(), category, topic, location)
+        else:
+            rrulestr(rule, forceset=True)   # fail early on invalid rules
+            recurrences.append((category, rule, topic, location))
+    if num_unclassified > 0:
+        logging.debug(str(num_unclassified) + " events of " + filename + " do not match any category")
+    parsed = ParsedIcsFile(events, recurrences)
+    parsed.parse_sec = perf_counter() - start
+    parsed.classify_sec = classify_sec
+    return parsed
+
+
+
+def outcome(result):
+    # unwraps a result gathered with return_exceptions
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+
+
+class CachedIcsFile:
+
+    def __init__(self, mtime: int, size: int, digest: str, parsed: Optional[ParsedIcsFile]):
+        self.mtime = mtime
+        self.size = size
+        self.digest = digest
+        self.parsed = parsed
+
+
+class IcsFileCache:
+    """
+    per-file parse cache. A file is re-parsed only if its (mtime, size) changed and its content hash differs.
+    The cache may be shared by several schedules. Schedules parsing the same file differently (other categories,
+    strict mode) use different variant keys (json-serializable, such as strings).
+    If a snapshot file is given, the cache is restored from and persisted to this file
+    """
+
+    SNAPSHOT_MAGIC = b"WCSNAP03"
+    SNAPSHOT_HEADER = struct.Struct("=8sI")
+    SNAPSHOT_ENTRY = struct.Struct("=HHqq32sII")
+
+    def __init__(self, snapshot_file: str = None):
+        self.__lock = Lock()
+        self.__entries: Dict[Tuple[str, Hashable], CachedIcsFile] = {}
+        self.__is_dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.snapshot_file = snapshot_file
+        self.is_restored = False   # true, if the entries have been restored from the snapshot (and not yet verified)
+        if snapshot_file is not None and os.path.isfile(snapshot_file):
+            try:
+                self.__load_snapshot()
+                self.is_restored = True
+            except Exception as e:
+                logging.warning("ignoring invalid snapshot " + snapshot_file + " " + str(e))
+                self.__entries = {}
+
+    def lookup(self, filename: str, verify: bool = True, variant: Hashable = None) -> Tuple[Optional[ParsedIcsFile], Optional[CachedIcsFile]]:
+        """
+        returns the cached parsed file or None, if the file has to be parsed. In this case the returned file signature
+        has to be passed to put() together with the parsed events
+        """
+        with self.__lock:
+            key = (filename, variant)
+            entry = self.__entries.get(key)
+            if entry is not None and not verify:
+                self.hits += 1
+                return entry.parsed, None
+
+            stat = os.stat(filename)
+            if entry is not None and entry.mtime == stat.st_mtime_ns and entry.size == stat.st_size:
+                self.hits += 1
+                return entry.parsed, None
+
+            digest = self.__digest(filename)
+            if entry is not None and entry.digest == digest:
+                # touched, but unchanged content
+                self.hits += 1
+                self.__entries[key] = CachedIcsFile(stat.st_mtime_ns, stat.st_size, digest, entry.parsed)
+                self.__is_dirty = True
+                return entry.parsed, None
+
+            return None, CachedIcsFile(stat.st_mtime_ns, stat.st_size, digest, None)
+
+    def put(self, filename: str, signature: CachedIcsFile, parsed: ParsedIcsFile, variant: Hashable = None):
+        with self.__lock:
+            self.misses += 1
+            self.__entries[(filename, variant)] = CachedIcsFile(signature.mtime, signature.size, signature.digest, parsed)
+            self.__is_dirty = True
+
+    def __digest(self, filename: str) -> str:
+        sha = hashlib.sha256()
+        with open(filename, 'rb') as file:
+            for chunk in iter(lambda: file.read(64 * 1024), b""):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def retain(self, directory: str, filenames: List[str]):
+        # drops the entries of the directory's files which are not listed anymore
+        directory = os.path.abspath(directory)
+        retained = {os.path.abspath(filename) for filename in filenames}
+        with self.__lock:
+            for key in [key for key in self.__entries.keys() if os.path.dirname(os.path.abspath(key[0])) == directory and os.path.abspath(key[0]) not in retained]:
+                logging.info("dropping cached events of removed file " + key[0])
+                del self.__entries[key]
+                self.__is_dirty = True
+
+    def save_snapshot(self):
+        """
+        writes the entries to the snapshot file, if modified. The columns of the event stores are written
+        as raw arrays, the interned tables and the recurrences as json
+        """
+        if self.snapshot_file is None:
+            return
+        with self.__lock:
+            if not self.__is_dirty:
+                return
+            chunks = [self.SNAPSHOT_HEADER.pack(self.SNAPSHOT_MAGIC, len(self.__entries))]
+            for (filename, variant), entry in self.__entries.items():
+                encoded_filename = filename.encode('utf-8')
+                encoded_variant = json.dumps(variant).encode('utf-8')
+                events = entry.parsed.events
+                encoded_tables = json.dumps({'categories': events.categories.values, 'summaries': events.summaries.values, 'locations': events.locations.values,
+                                             'sources': events.sources.values, 'recurrences': entry.parsed.recurrences}).encode('utf-8')
+                chunks.append(self.SNAPSHOT_ENTRY.pack(len(encoded_filename), len(encoded_variant), entry.mtime, entry.size, bytes.fromhex(entry.digest), len(encoded_tables), len(events)))
+                chunks.append(encoded_filename)
+                chunks.append(encoded_variant)
+                chunks.append(encoded_tables)
+                for column in (events.days, events.category_ids, events.summary_ids, events.location_ids, events.source_ids):
+                    chunks.append(bytes(column))
+            self.__is_dirty = False
+        tmp_file = self.snapshot_file + ".tmp"
+        with open(tmp_file, 'wb') as file:
+            file.write(b"".join(chunks))
+        os.replace(tmp_file, self.snapshot_file)   # atomic
+        logging.debug("snapshot " + self.snapshot_file + " written")
+
+    def __load_snapshot(self):
+        with open(self.snapshot_file, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, num_entries = self.SNAPSHOT_HEADER.unpack_from(mm, 0)
+            if magic != self.SNAPSHOT_MAGIC:
+                raise ValueError("unsupported snapshot format")
+            offset = self.SNAPSHOT_HEADER.size
+            for _ in range(num_entries):
+                filename_len, variant_len, mtime, size, digest, tables_len, num_events = self.SNAPSHOT_ENTRY.unpack_from(mm, offset)
+                offset += self.SNAPSHOT_ENTRY.size
+                filename = mm[offset:offset + filename_len].decode('utf-8')
+                offset += filename_len
+                variant = json.loads(mm[offset:offset + variant_len].decode('utf-8'))
+                offset += variant_len
+                tables = json.loads(mm[offset:offset + tables_len].decode('utf-8'))
+                offset += tables_len
+                events = EventStore()
+                events.categories, events.summaries, events.locations, events.sources = (InternTable(tables['categories']), InternTable(tables['summaries']),
+                                                                                         InternTable(tables['locations']), InternTable(tables['sources']))
+                events.days.frombytes(mm[offset:offset + events.days.itemsize * num_events])
+                offset += events.days.itemsize * num_events
+                events.category_ids = bytearray(mm[offset:offset + num_events])
+                offset += num_events
+                for column in (events.summary_ids, events.location_ids, events.source_ids):
+                    column.frombytes(mm[offset:offset + column.itemsize * num_events])
+                    offset += column.itemsize * num_events
+                recurrences = [tuple(recurrence) for recurrence in tables['recurrences']]
+                self.__entries[(filename, variant)] = CachedIcsFile(mtime, size, digest.hex(), ParsedIcsFile(events, recurrences))
+        logging.info(str(len(self.__entries)) + " cached ics files restored from snapshot " + self.snapshot_file)
+
+    def __len__(self):
+        return len(self.__entries)
+
+
+
+class ScheduleChange:
+    """
+    the diff published to the listener after a reload
+    """
+
+    def __init__(self, snapshot: 'ScheduleSnapshot', next_dates: Dict[str, datetime], changed_categories: Set[str], files_changed: bool):
+        self.snapshot = snapshot                       # the state the diff has been computed of
+        self.next_dates = next_dates
+        self.changed_categories = changed_categories   # categories whose next date changed
+        self.files_changed = files_changed             # the list of scanned files changed
+
+
+
+class ChangeSubscription:
+    """
+    awaitable changes of a schedule (refer WasteCollectionSchedule.subscribe). Changes published while the
+    subscriber is busy are merged, so a slow subscriber gets the latest state including all categories
+    changed in between
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.__loop = loop
+        self.__pending: Optional[ScheduleChange] = None
+        self.__available = asyncio.Event()
+
+    def publish(self, change: ScheduleChange):
+        # may be called by any thread
+        try:
+            self.__loop.call_soon_threadsafe(self.__merge, change)
+        except RuntimeError:
+            pass   # the loop is closed
+
+    def __merge(self, change: ScheduleChange):
+        pending = self.__pending
+        if pending is not None:
+            change = ScheduleChange(change.snapshot, change.next_dates, pending.changed_categories | change.changed_categories, pending.files_changed or change.files_changed)
+        self.__pending = change
+        self.__available.set()
+
+    async def get(self) -> ScheduleChange:
+        await self.__available.wait()
+        self.__available.clear()
+        change, self.__pending = self.__pending, None
+        return change
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> ScheduleChange:
+        return await self.get()
+
+
+
+class Timeline:
+    """
+    the collections of all categories as a single day-sorted index. A view over the columns of a day-sorted
+    event store, so no copy is made. Range and top-N queries cost O(log n + k)
+    """
+
+    def __init__(self, events: EventStore):
+        self.categories = events.categories        # interned category names
+        self.days = events.days                    # sorted date ordinals
+        self.category_ids = events.category_ids    # index into categories
+
+    def __len__(self):
+        return len(self.days)
+
+    def __slice(self, start_idx: int, end_idx: int) -> List[Tuple[datetime, str]]:
+        return [(datetime.fromordinal(self.days[idx]), self.categories[self.category_ids[idx]]) for idx in range(start_idx, min(end_idx, len(self.days)))]
+
+    def between(self, start: datetime, end: datetime) -> List[Tuple[datetime, str]]:
+        # collections within [start, end] (day granularity)
+        return self.__slice(bisect_left(self.days, start.toordinal()), bisect_right(self.days, end.toordinal()))
+
+    def first(self, start_ordinal: int, count: int) -> List[Tuple[datetime, str]]:
+        # the first count collections on or after the given day
+        start_idx = bisect_left(self.days, start_ordinal)
+        return self.__slice(start_idx, start_idx + max(count, 0))
+
+
+
+def min_ordinal(now: Optional[datetime] = None) -> int:
+    # a collection day is considered as upcoming until 8 hours after its start
+    cutoff = (datetime.now() if now is None else now) - timedelta(hours=8)
+    return cutoff.toordinal() if cutoff == day_granularity(cutoff) else cutoff.toordinal() + 1
+
+
+class ScheduleSnapshot:
+    """
+    the immutable state of a schedule. A reload publishes a new snapshot by a single reference swap, so
+    readers pinning a snapshot never see a mix of old and new state and do not need any lock.
+    The series arrays must not be modified once published
+    """
+
+    __slots__ = ('events', 'timeseries', 'timeline', 'scanned_ics_files', 'generation')
+
+    EMPTY_SERIES = array('i')
+
+    def __init__(self, events: EventStore, categories: List[str], scanned_ics_files: List[str], generation: int):
+        series = events.series()
+        timeseries = {name: series.get(name, array('i')) for name in categories}
+        object.__setattr__(self, 'events', events)   # all collection events sorted by day
+        object.__setattr__(self, 'timeseries', MappingProxyType(timeseries))   # category name -> sorted collection days (date ordinals)
+        object.__setattr__(self, 'timeline', Timeline(events))
+        object.__setattr__(self, 'scanned_ics_files', tuple(scanned_ics_files))
+        object.__setattr__(self, 'generation', generation)   # incremented on each reload
+
+    def __setattr__(self, name, value):
+        raise AttributeError("schedule snapshots are immutable")
+
+    def series(self, category: str) -> array:
+        return self.timeseries.get(category, self.EMPTY_SERIES)
+
+    def next_date(self, category: str, now: Optional[datetime] = None) -> Optional[datetime]:
+        series = self.series(category)
+        idx = bisect_left(series, min_ordinal(now))
+        if idx < len(series):
+            return datetime.fromordinal(series[idx])
+
+    def next_dates(self, now: Optional[datetime] = None) -> Dict[str, datetime]:
+        # all next dates based on a single time snapshot
+        ordinal = min_ordinal(now)
+        dates = {}
+        for name in ('organic', 'recycling', 'paper', 'residual', *self.timeseries.keys()):
+            series = self.series(name)
+            idx = bisect_left(series, ordinal)
+            dates[name] = datetime.fromordinal(series[idx]) if idx < len(series) else None
+        return dates
+
+    def upcoming_dates(self, category: str, count: int, now: Optional[datetime] = None) -> List[datetime]:
+        series = self.series(category)
+        idx = bisect_left(series, min_ordinal(now))
+        return [datetime.fromordinal(ordinal) for ordinal in series[idx:idx + max(count, 0)]]
+
+    def dates_between(self, category: str, start: datetime, end: datetime) -> List[datetime]:
+        # collection days within [start, end] (day granularity)
+        series = self.series(category)
+        return [datetime.fromordinal(ordinal) for ordinal in series[bisect_left(series, start.toordinal()):bisect_right(series, end.toordinal())]]
+
+    def collections_between(self, start: datetime, end: datetime) -> List[Tuple[datetime, str]]:
+        # (date, category) of all collections within [start, end], sorted by date
+        return self.timeline.between(start, end)
+
+    def upcoming_collections(self, count: int, now: Optional[datetime] = None) -> List[Tuple[datetime, str]]:
+        # (date, category) of the next count collections of any category
+        return self.timeline.first(min_ordinal(now), count)
+
+    def events_between(self, start: datetime, end: datetime) -> List[Tuple[datetime, str, str, str, str]]:
+        # (date, category, summary, location, source file) of all collections within [start, end], sorted by date
+        return self.events.between(start, end)
+
+    def upcoming_events(self, count: int, now: Optional[datetime] = None) -> List[Tuple[datetime, str, str, str, str]]:
+        return self.events.first(min_ordinal(now), count)
+
+
+
+class ReloadScheduler:
+    """
+    runs the reloads of one or more schedules on a single thread. Reloads requested by the schedules' watchers
+    are executed as they come in, all registered schedules are reloaded periodically. The files of schedules
+    with watcher are fully verified every verify_interval_sec only, in case the watcher missed changes
+    """
+
+    def __init__(self, interval_sec: float = 27 * 60, verify_interval_sec: float = 6 * 60 * 60):
+        self.interval_sec = interval_sec
+        self.verify_interval_sec = verify_interval_sec
+        self.__lock = Lock()
+        self.__schedules: List['WasteCollectionSchedule'] = []
+        self.__requests = Queue()
+        self.__thread: Optional[Thread] = None
+
+    def register(self, schedule: 'WasteCollectionSchedule'):
+        with self.__lock:
+            if schedule not in self.__schedules:
+                self.__schedules.append(schedule)
+            if self.__thread is None:
+                self.__thread = Thread(target=self.__loop, daemon=True)
+                self.__thread.start()
+
+    def deregister(self, schedule: 'WasteCollectionSchedule'):
+        with self.__lock:
+            if schedule in self.__schedules:
+                self.__schedules.remove(schedule)
+
+    def request_reload(self, schedule: 'WasteCollectionSchedule', changed_files: Optional[Set[str]] = None):
+        self.__requests.put((schedule, changed_files))
+
+    def __loop(self):
+        next_periodic_reload = time() + self.interval_sec
+        while True:
+            try:
+                schedule, changed_files = self.__requests.get(timeout=max(0.0, next_periodic_reload - time()))
+                with self.__lock:
+                    is_registered = schedule in self.__schedules
+                if is_registered:
+                    self.__reload(schedule, changed_files)
+            except Empty:
+                with self.__lock:
+                    schedules = list(self.__schedules)
+                for schedule in schedules:
+                    # schedules with watcher are reloaded on reported changes (or to poll the remote sources
+                    # and to slide the recurrence window). Their files are verified at a low frequency only
+                    if schedule.watcher is None or schedule.is_verification_due(self.verify_interval_sec):
+                        self.__reload(schedule, None)
+                    elif schedule.remote is not None or schedule.is_window_outdated():
+                        self.__reload(schedule, set())
+                next_periodic_reload = time() + self.interval_sec
+
+    def __reload(self, schedule: 'WasteCollectionSchedule', changed_files: Optional[Set[str]]):
+        try:
+            schedule.reload(changed_files)
+        except Exception as e:
+            logging.warning("error occurred on reloading " + schedule.directory + " " + str(e))
+
+
+
+class AsyncReloadScheduler:
+    """
+    asyncio variant of the ReloadScheduler. The reloads of the registered schedules run as coroutines on the
+    event loop (refer WasteCollectionSchedule.reload_async), reloads may be requested by any thread.
+    Deregistering the last schedule cancels the reload task immediately, including a running reload
+    """
+
+    def __init__(self, interval_sec: float = 27 * 60, loop: asyncio.AbstractEventLoop = None, verify_interval_sec: float = 6 * 60 * 60):
+        self.interval_sec = interval_sec
+        self.verify_interval_sec = verify_interval_sec
+        self.__loop = loop
+        self.__schedules: List['WasteCollectionSchedule'] = []
+        self.__requests: Optional[asyncio.Queue] = None
+        self.__task: Optional[asyncio.Task] = None
+
+    def __bind(self) -> asyncio.AbstractEventLoop:
+        if self.__loop is None:
+            self.__loop = asyncio.get_event_loop()
+        if self.__requests is None:
+            self.__requests = asyncio.Queue()
+        return self.__loop
+
+    def register(self, schedule: 'WasteCollectionSchedule'):
+        # has to be called on the loop's thread
+        loop = self.__bind()
+        if schedule not in self.__schedules:
+            self.__schedules.append(schedule)
+        if self.__task is None:
+            self.__task = loop.create_task(self.__run())
+
+    def deregister(self, schedule: 'WasteCollectionSchedule'):
+        if schedule in self.__schedules:
+            self.__schedules.remove(schedule)
+        if len(self.__schedules) == 0 and self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+
+    def request_reload(self, schedule: 'WasteCollectionSchedule', changed_files: Optional[Set[str]] = None):
+        self.__bind().call_soon_threadsafe(self.__requests.put_nowait, (schedule, changed_files))
+
+    async def close(self):
+        # cancels the reload task and waits for its termination
+        task, self.__task = self.__task, None
+        self.__schedules = []
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def __run(self):
+        loop = asyncio.get_running_loop()
+        next_periodic_reload = loop.time() + self.interval_sec
+        while True:
+            try:
+                schedule, changed_files = await asyncio.wait_for(self.__requests.get(), timeout=max(0.0, next_periodic_reload - loop.time()))
+                if schedule in self.__schedules:
+                    await self.__reload(schedule, changed_files)
+            except asyncio.TimeoutError:
+                for schedule in list(self.__schedules):
+                    # refer ReloadScheduler
+                    if schedule.watcher is None or schedule.is_verification_due(self.verify_interval_sec):
+                        await self.__reload(schedule, None)
+                    elif schedule.remote is not None or schedule.is_window_outdated():
+                        await self.__reload(schedule, set())
+                next_periodic_reload = loop.time() + self.interval_sec
+
+    async def __reload(self, schedule: 'WasteCollectionSchedule', changed_files: Optional[Set[str]]):
+        try:
+            await schedule.reload_async(changed_files)
+        except Exception as e:
+            logging.warning("error occurred on reloading " + schedule.directory + " " + str(e))
 
 
 
 class WasteCollectionSchedule:
 
-    def __init__(self, directory: str):
-        self.__is_running = True
-        self.__listener = lambda: None    # "empty" listener
-        self.directory = directory
-        self.organic_timeseries = []
-        self.recycling_timeseries = []
-        self.residual_timeseries = []
-        self.paper_timeseries = []
-        self.scanned_ics_files = []
-        self.__reload()
-
-    def set_listener(self,listener):
+    def __init__(self, directory: str, watcher: str = 'auto', debounce_sec: float = 2, strict: bool = False, parse_workers: int = 0, parse_executor: str = 'process',
+                 categories: CategoryRegistry = None, cache: IcsFileCache = None, scheduler: Union[ReloadScheduler, AsyncReloadScheduler] = None, recurrence_horizon_days: int = 365,
+                 remote: RemoteSources = None, metrics: Metrics = None, initial_reload: bool = True):
+        self.__listener = lambda change: None    # "empty" listener
+        self.__subscriptions: List[ChangeSubscription] = []
+        self.__async_reload_lock = asyncio.Lock()
+        self.__published_next_dates: Dict[str, datetime] = {}
+        self.__verified_time = 0.0   # last reload verifying all files
+        self.__diff_lock = RLock()   # reentrant, a listener may call refresh()
+        self.__reload_lock = Lock()
+        self.directory = os.path.abspath(directory)   # normalized, e.g. to match the cached files by directory
+        self.strict = strict   # strict: full parse by the ics library. Otherwise the streaming VEVENT reader is used
+        self.watcher = create_watcher(watcher, self.directory, self.__on_files_changed, debounce_sec)
+        self.parse_workers = parse_workers    # 0: files are parsed sequentially on the reload thread
+        self.parse_executor = parse_executor  # 'process' or 'thread'
+        self.__executor: Optional[Executor] = None
+        self.categories = CategoryRegistry.for_directory(directory) if categories is None else categories
+        self.remote = RemoteSources.for_directory(directory) if remote is None else remote   # None, if no remote sources are configured
+        self.__cache_variant = json.dumps([strict, self.categories.fingerprint])
+        self.snapshot = ScheduleSnapshot(EventStore(), self.categories.names, [], 0)
+        self.recurrence_horizon_days = recurrence_horizon_days
+        self.__window: Optional[Tuple[datetime, datetime]] = None
+        self.__expanded: Dict[str, Tuple[ParsedIcsFile, Tuple[datetime, datetime], EventStore]] = {}
+        self.cache = IcsFileCache() if cache is None else cache
+        self.scheduler = ReloadScheduler() if scheduler is None else scheduler
+        self.metrics = default_metrics if metrics is None else metrics
+        self.__pending_profile: Optional[ReloadProfile] = None
+        # with a restored cache, serving starts with the snapshot's entries. They will be verified on start()
+        if initial_reload:
+            self.reload(set() if self.cache.is_restored else None)
+
+    def set_listener(self, listener: Callable[[ScheduleChange], None]):
         self.__listener = listener
 
+    @property
+    def timeseries(self) -> Mapping[str, array]:
+        return self.snapshot.timeseries
+
+    @property
+    def timeline(self) -> Timeline:
+        return self.snapshot.timeline
+
+    @property
+    def scanned_ics_files(self) -> List[str]:
+        return list(self.snapshot.scanned_ics_files)
+
+    @property
+    def generation(self) -> int:
+        return self.snapshot.generation
+
+    @property
+    def organic_timeseries(self) -> array:
+        return self.snapshot.series('organic')
+
+    @property
+    def recycling_timeseries(self) -> array:
+        return self.snapshot.series('recycling')
+
+    @property
+    def paper_timeseries(self) -> array:
+        return self.snapshot.series('paper')
+
+    @property
+    def residual_timeseries(self) -> array:
+        return self.snapshot.series('residual')
+
     @property
     def next_organic(self) -> datetime:
-        return self.__next(self.organic_timeseries)
+        return self.snapshot.next_date('organic')
 
     @property
     def next_recycling(self) -> datetime:
-        return self.__next(self.recycling_timeseries)
+        return self.snapshot.next_date('recycling')
 
     @property
     def next_paper(self) -> datetime:
-        return self.__next(self.paper_timeseries)
+        return self.snapshot.next_date('paper')
 
     @property
     def next_residual(self) -> datetime:
-        return self.__next(self.residual_timeseries)
+        return self.snapshot.next_date('residual')
+
+    # the queries below are answered by the current snapshot. Readers requiring several consistent queries
+    # have to pin the snapshot (snapshot = schedule.snapshot) and to query it directly
+
+    def next_date(self, category: str, now: Optional[datetime] = None) -> Optional[datetime]:
+        return self.snapshot.next_date(category, now)
+
+    def next_dates(self, now: Optional[datetime] = None) -> Dict[str, datetime]:
+        return self.snapshot.next_dates(now)
+
+    def upcoming_dates(self, category: str, count: int, now: Optional[datetime] = None) -> List[datetime]:
+        return self.snapshot.upcoming_dates(category, count, now)
 
-    def __next(self, timeseries : List[datetime]) -> datetime:
-        for date in timeseries:
-            if date >= (datetime.now() - timedelta(hours=8)):
-                return date
+    def dates_between(self, category: str, start: datetime, end: datetime) -> List[datetime]:
+        return self.snapshot.dates_between(category, start, end)
+
+    def collections_between(self, start: datetime, end: datetime) -> List[Tuple[datetime, str]]:
+        return self.snapshot.collections_between(start, end)
+
+    def upcoming_collections(self, count: int, now: Optional[datetime] = None) -> List[Tuple[datetime, str]]:
+        return self.snapshot.upcoming_collections(count, now)
+
+    def events_between(self, start: datetime, end: datetime) -> List[Tuple[datetime, str, str, str, str]]:
+        return self.snapshot.events_between(start, end)
 
     def __scan_ics_files(self):
         logging.info("parsing dir " + self.directory)
         files = []
-        for file in os.listdir(self.directory):
+        for file in sorted(os.listdir(self.directory)):
             if file.endswith('.ics'):
                 files.append(os.path.join(self.directory, file))
         return files
 
-    def __read_ics_file(self, filename: str):
-        ignore_section = False
-        content = ""
-        with open(filename, 'r') as file:
-            for line in file.readlines():
-                if line.startswith("BEGIN:VALARM"):
-                    ignore_section = True
-                elif line.startswith("END:VALARM"):
-                    ignore_section = False
-                elif not ignore_section:
-                    content = content + line
-        return content
-
-    def __reload(self):
-        new_recycling_timeseries = []
-        new_organic_timeseries = []
-        new_residual_timeseries = []
-        new_paper_timeseries = []
-
-        files = self.__scan_ics_files()
-        for file in files:
-            num_loaded = 0
+    def __get_executor(self) -> Executor:
+        if self.__executor is None:
+            if self.parse_executor == 'thread':
+                self.__executor = ThreadPoolExecutor(max_workers=self.parse_workers, thread_name_prefix="ics_parser")
+            else:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                # spawn instead of fork, the reload runs in a multi-threaded process
+                self.__executor = ProcessPoolExecutor(max_workers=self.parse_workers, mp_context=multiprocessing.get_context('spawn'))
+        return self.__executor
+
+    def __discard_executor(self, executor: Executor, error: Exception):
+        # a broken pool (e.g. a worker killed by the OOM killer) is dropped and recreated on the next use
+        if self.__executor is executor:
+            logging.warning("parse worker pool broken (" + str(error) + "). Falling back to parse in-process for this reload")
+            self.__executor = None
+            executor.shutdown(wait=False)
+
+    def __lookup_files(self, files: List[str], changed_files: Optional[Set[str]]) -> Tuple[Dict[str, ParsedIcsFile], Dict[str, CachedIcsFile]]:
+        # returns the files served by the cache and the signatures of the files to parse
+        parsed = {}
+        to_parse = {}
+        with self.metrics.time_stage('read', directory=self.directory):
+            for file in files:
+                try:
+                    parsed_file, signature = self.cache.lookup(file, verify=changed_files is None or file in changed_files, variant=self.__cache_variant)
+                    if parsed_file is None:
+                        to_parse[file] = signature
+                    else:
+                        parsed[file] = parsed_file
+                except Exception as e:
+                    self.__count_error('read')
+                    logging.warning("error occurred parsing " + file + " " + str(e))
+        return parsed, to_parse
+
+    def __parse_files(self, to_parse: Dict[str, CachedIcsFile], parsed: Dict[str, ParsedIcsFile]):
+        with self.metrics.time_stage('parse', directory=self.directory):
+            if self.parse_workers > 0 and len(to_parse) > 1:
+                executor = self.__get_executor()
+                futures: Dict[str, Future] = {}
+                try:
+                    for file in to_parse.keys():
+                        futures[file] = executor.submit(parse_ics_file, file, self.strict, self.categories)
+                except BrokenExecutor as e:
+                    self.__discard_executor(executor, e)
+                for file in to_parse.keys():
+                    self.__store_parsed(file, to_parse[file], lambda: self.__pool_result(executor, futures.get(file), file), parsed)
+            else:
+                for file in to_parse.keys():
+                    logging.info("parsing " + file)
+                    self.__store_parsed(file, to_parse[file], lambda: parse_ics_file(file, self.strict, self.categories), parsed)
+
+    def __pool_result(self, executor: Executor, future: Optional[Future], file: str) -> ParsedIcsFile:
+        if future is not None:
+            try:
+                return future.result()
+            except BrokenExecutor as e:
+                self.__discard_executor(executor, e)
+        logging.info("parsing " + file)
+        return parse_ics_file(file, self.strict, self.categories)
+
+    async def __parse_file_async(self, file: str) -> ParsedIcsFile:
+        loop = asyncio.get_running_loop()
+        if self.parse_workers > 0:
+            executor = self.__get_executor()
             try:
-                logging.info("parsing " + file)
-                content = self.__read_ics_file(file)
-                c = Calendar(content)
-                for event in c.events:
-                    num_loaded += 1
-                    date = day_granularity(event.begin.datetime)
-                    topic = event.name
-                    if 'bio' in topic.lower():
-                        new_organic_timeseries.append(date)
-                    elif 'wertstoff' in topic.lower():
-                        new_recycling_timeseries.append(date)
-                    elif 'papier' in topic.lower():
-                        new_paper_timeseries.append(date)
-                    elif 'rest' in topic.lower():
-                        new_residual_timeseries.append(date)
-                logging.info(str(num_loaded) + " reminders loaded for " + file)
+                return await loop.run_in_executor(executor, parse_ics_file, file, self.strict, self.categories)
+            except BrokenExecutor as e:
+                self.__discard_executor(executor, e)
+        return await loop.run_in_executor(None, parse_ics_file, file, self.strict, self.categories)
+
+    async def __parse_files_async(self, to_parse: Dict[str, CachedIcsFile], parsed: Dict[str, ParsedIcsFile]):
+        # the parse is offloaded to the worker pool (or the loop's default executor, if no workers are configured)
+        with self.metrics.time_stage('parse', directory=self.directory):
+            results = await asyncio.gather(*[self.__parse_file_async(file) for file in to_parse.keys()], return_exceptions=True)
+            for file, result in zip(to_parse.keys(), results):
+                self.__store_parsed(file, to_parse[file], lambda: outcome(result), parsed)
+
+    def __store_parsed(self, file: str, signature: CachedIcsFile, parse: Callable[[], ParsedIcsFile], parsed: Dict[str, ParsedIcsFile]):
+        try:
+            parsed[file] = parse()
+            self.cache.put(file, signature, parsed[file], variant=self.__cache_variant)
+        except Exception as e:
+            self.__count_error('parse')
+            logging.warning("error occurred parsing " + file + " " + str(e))
+
+    def __count_error(self, stage: str):
+        self.metrics.inc("waste_collection_errors_total", 1, "number of errors by reload stage", directory=self.directory, stage=stage)
+
+    def recurrence_window(self, now: Optional[datetime] = None) -> Tuple[datetime, datetime]:
+        # recurring events are expanded from the start of the current month up to the horizon
+        now = datetime.now() if now is None else now
+        window_start = datetime(now.year, now.month, 1)
+        return window_start, window_start + timedelta(days=self.recurrence_horizon_days)
+
+    def is_verification_due(self, interval_sec: float) -> bool:
+        # all files have not been verified within the interval (a watcher may have missed changes)
+        return time() - self.__verified_time >= interval_sec
+
+    def is_window_outdated(self, now: Optional[datetime] = None) -> bool:
+        return self.__window != self.recurrence_window(now)
+
+    def __expand(self, file: str, parsed: ParsedIcsFile, window: Tuple[datetime, datetime]) -> EventStore:
+        # the occurrences are memoized per file as long as the parsed file and the window are unchanged
+        if len(parsed.recurrences) == 0:
+            return EventStore()
+        memo = self.__expanded.get(file)
+        if memo is None or memo[0] is not parsed or memo[1] != window:
+            try:
+                memo = (parsed, window, parsed.expand(*window))
             except Exception as e:
-                logging.warning("error occurred parsing " + file + " " + str(e))
+                self.__count_error('expand')
+                logging.warning("error occurred expanding recurring events of " + file + " " + str(e))
+                memo = (parsed, window, EventStore())
+            self.__expanded[file] = memo
+        return memo[2]
 
-        self.recycling_timeseries = sorted(new_recycling_timeseries)
-        self.organic_timeseries = sorted(new_organic_timeseries)
-        self.residual_timeseries = sorted(new_residual_timeseries)
-        self.paper_timeseries = sorted(new_paper_timeseries)
-        self.scanned_ics_files = files
-        self.__listener()
+    def __on_files_changed(self, changed_files: Optional[Set[str]]):
+        # None: the watcher lost track of the changes, all files are verified
+        self.scheduler.request_reload(self, changed_files)
 
-    def start(self):
-        Thread(target=self.__reload_loop, daemon=True).start()
+    def profile_next_reload(self, mode: str) -> ReloadProfile:
+        """
+        the next reload will be captured by cProfile or tracemalloc (mode 'cprofile' or 'tracemalloc').
+        The report is delivered by the future of the returned profile
+        """
+        profile = ReloadProfile(mode)
+        self.__pending_profile = profile
+        return profile
 
-    def stop(self):
-        self.__is_running = False
+    def reload(self, changed_files: Optional[Set[str]] = None):
+        # changed_files None means every file will be checked for modifications
+        with self.__reload_lock:
+            profile, self.__pending_profile = self.__pending_profile, None
+            if profile is None:
+                self.__reload_measured(changed_files)
+            else:
+                profile.run(lambda: self.__reload_measured(changed_files))
 
-    def __reload_loop(self):
-        while self.__is_running:
+    async def reload_async(self, changed_files: Optional[Set[str]] = None):
+        """
+        asyncio variant of reload(). Only the parse of the modified files and the fetch of the remote sources
+        are offloaded to executors, the other steps run on the event loop. If the coroutine is cancelled,
+        the published snapshot remains unchanged
+        """
+        async with self.__async_reload_lock:
+            if self.__pending_profile is not None:
+                # a profile captures the blocking reload, which is run off the loop
+                await asyncio.get_running_loop().run_in_executor(None, self.reload, changed_files)
+                return
             try:
-                self.__reload()
-                sleep(27 * 60)
+                with self.metrics.time_stage('reload', directory=self.directory):
+                    files, changed_files = await self.__scan_files_async(changed_files)
+                    hits, misses = self.cache.hits, self.cache.misses
+                    parsed, to_parse = self.__lookup_files(files, changed_files)
+                    await self.__parse_files_async(to_parse, parsed)
+                    self.__publish(files, parsed, to_parse, hits, misses)
+            except Exception:
+                self.__count_error('reload')
+                raise
+            self.__reload_succeeded(changed_files is None)
+
+    def __reload_measured(self, changed_files: Optional[Set[str]]):
+        try:
+            with self.metrics.time_stage('reload', directory=self.directory):
+                files, changed_files = self.__scan_files(changed_files)
+                hits, misses = self.cache.hits, self.cache.misses
+                parsed, to_parse = self.__lookup_files(files, changed_files)
+                self.__parse_files(to_parse, parsed)
+                self.__publish(files, parsed, to_parse, hits, misses)
+        except Exception:
+            self.__count_error('reload')
+            raise
+        self.__reload_succeeded(changed_files is None)
+
+    def __reload_succeeded(self, verified_all: bool):
+        if verified_all:
+            self.__verified_time = time()
+        self.metrics.inc("waste_collection_reloads_total", 1, "number of successful reloads", directory=self.directory)
+        self.metrics.set("waste_collection_last_reload_timestamp_seconds", time(), "unix time of the last successful reload", directory=self.directory)
+        for name, series in self.snapshot.timeseries.items():
+            self.metrics.set("waste_collection_events", len(series), "number of loaded collection days by category", directory=self.directory, category=name)
+
+    def __scan_files(self, changed_files: Optional[Set[str]]) -> Tuple[List[str], Optional[Set[str]]]:
+        # returns the files to load and the changed files extended by the modified remote sources
+        with self.metrics.time_stage('scan', directory=self.directory):
+            files = self.__scan_ics_files()
+        if self.remote is not None:
+            try:
+                with self.metrics.time_stage('remote', directory=self.directory):
+                    fetched = self.remote.refresh()
+                if changed_files is not None:
+                    changed_files = changed_files | fetched
             except Exception as e:
-                logging.warning("error occurred on sync " + str(e))
-                sleep(60)
\ No newline at end of file
+                self.__count_error('remote')
+                logging.warning("error occurred refreshing remote sources " + str(e))
+            files = files + self.remote.files
+        return files, changed_files
+
+    async def __scan_files_async(self, changed_files: Optional[Set[str]]) -> Tuple[List[str], Optional[Set[str]]]:
+        if self.remote is None:
+            return self.__scan_files(changed_files)
+        # the remote sources are fetched by blocking http requests
+        return await asyncio.get_running_loop().run_in_executor(None, self.__scan_files, changed_files)
+
+    def __publish(self, files: List[str], parsed: Dict[str, ParsedIcsFile], to_parse: Dict[str, CachedIcsFile], hits: int, misses: int):
+        # the classification is interleaved with the parse. Its share is measured by the parse itself
+        self.metrics.observe("waste_collection_stage_seconds", sum(parsed[file].classify_sec for file in to_parse.keys() if file in parsed), stage='classify', directory=self.directory)
+        for file in to_parse.keys():
+            if file in parsed:
+                self.metrics.set("waste_collection_file_parse_seconds", parsed[file].parse_sec, "duration of the last parse of the ics file", file=file)
+        self.metrics.inc("waste_collection_files_parsed_total", len([file for file in to_parse.keys() if file in parsed]), "number of parsed ics files (cache misses)", directory=self.directory)
+
+        events = EventStore()
+        window = self.recurrence_window()
+        with self.metrics.time_stage('expand', directory=self.directory):
+            for file in files:    # merge in file order to get deterministic results
+                if file in parsed:
+                    events.extend(parsed[file].events, source=file)
+                    events.extend(self.__expand(file, parsed[file], window), source=file)
+                    logging.debug(str(len(parsed[file].events)) + " reminders and " + str(len(parsed[file].recurrences)) + " recurring events loaded for " + file)
+        self.__expanded = {file: expanded for file, expanded in self.__expanded.items() if file in parsed}
+        self.__window = window
+        self.cache.retain(self.directory, files)
+        if self.remote is not None:
+            self.cache.retain(self.remote.download_dir, files)
+        self.cache.save_snapshot()
+        logging.info(str(len(files)) + " ics files scanned (cache hits: " + str(self.cache.hits - hits) + ", cache misses: " + str(self.cache.misses - misses) + ")")
+        self.metrics.inc("waste_collection_cache_hits_total", self.cache.hits - hits, "number of ics files served by the parse cache", directory=self.directory)
+        self.metrics.inc("waste_collection_cache_misses_total", self.cache.misses - misses, "number of ics files missed by the parse cache", directory=self.directory)
+
+        previous = self.snapshot
+        with self.metrics.time_stage('sort', directory=self.directory):
+            snapshot = ScheduleSnapshot(events.sorted_by_day(self.categories.names), self.categories.names, files, previous.generation + 1)
+        for file in previous.scanned_ics_files:
+            if file not in snapshot.scanned_ics_files:
+                self.metrics.remove("waste_collection_file_parse_seconds", file=file)
+        self.snapshot = snapshot   # publish
+        with self.metrics.time_stage('notify', directory=self.directory):
+            self.__publish_change(snapshot.scanned_ics_files != previous.scanned_ics_files)
+
+    def __notify(self, change: ScheduleChange):
+        self.__listener(change)
+        for subscription in list(self.__subscriptions):
+            subscription.publish(change)
+
+    def subscribe(self) -> 'ChangeSubscription':
+        """
+        returns an awaitable subscription to the changes of the schedule (async for change in subscription: ...).
+        Has to be called on the event loop the changes will be awaited on
+        """
+        subscription = ChangeSubscription(asyncio.get_running_loop())
+        self.__subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: 'ChangeSubscription'):
+        if subscription in self.__subscriptions:
+            self.__subscriptions.remove(subscription)
+
+    def __publish_change(self, files_changed: bool):
+        # the snapshot is read and notified under the lock. Otherwise a refresh racing with a reload could diff and
+        # deliver an older snapshot after the newer one, reverting the published next dates to the stale state
+        with self.__diff_lock:
+            snapshot = self.snapshot
+            next_dates = snapshot.next_dates()
+            changed_categories = {name for name, date in next_dates.items() if name not in self.__published_next_dates or self.__published_next_dates[name] != date}
+            self.__published_next_dates = next_dates
+            self.__notify(ScheduleChange(snapshot, next_dates, changed_categories, files_changed))
+
+    def refresh(self):
+        # re-evaluates the time-dependent next dates and notifies the listener without touching the files.
+        # The change is published immediately, so the listener (re-)arms its rollover timer even if the
+        # reload sliding the window of the recurring events fails. Before the initial load there is no window to slide
+        self.__publish_change(False)
+        if self.__window is not None and self.is_window_outdated():
+            self.scheduler.request_reload(self, set())
+
+    def next_rollover(self, now: Optional[datetime] = None) -> datetime:
+        """
+        returns the next instant a time-dependent value may change: the next local midnight or the end
+        of the grace period of a collection day, whichever comes first
+        """
+        now = datetime.now() if now is None else now
+        rollover = day_granularity(now) + timedelta(days=1)
+        for date in self.next_dates(now).values():
+            if date is not None and now <= date + timedelta(hours=8) < rollover:
+                rollover = date + timedelta(hours=8)
+        return rollover
+
+    def start(self):
+        self.scheduler.register(self)
+        if self.cache.is_restored or self.generation == 0:
+            self.scheduler.request_reload(self, None)   # initial load or reconcile the snapshot with the files in background
+        if self.watcher is not None:
+            self.watcher.start()
+
+    def stop(self):
+        self.scheduler.deregister(self)
+        if self.watcher is not None:
+            self.watcher.stop()
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=False, cancel_futures=True)
+        if self.remote is not None:
+            self.remote.client.close()
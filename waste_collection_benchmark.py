@@ -0,0 +1,356 @@
+import os
+import sys
+import json
+import random
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import logging
+from datetime import datetime, timedelta
+from statistics import median
+from time import perf_counter
+from typing import Dict, Any, Callable, List, Optional, Tuple
+from waste_collection import WasteCollectionSchedule, IcsFileCache, EventStore, ScheduleSnapshot, read_events
+
+
+
+# category -> (summary, collection interval in days)
+CORPUS_CATEGORIES = {
+    'organic': ('Biotonne', 7),
+    'recycling': ('Wertstofftonne (Gelber Sack)', 14),
+    'paper': ('Papiertonne', 28),
+    'residual': ('Restmülltonne', 14),
+}
+
+
+def generate_corpus(directory: str, files: int = 20, years: int = 2, valarm_ratio: float = 0.5, rrule_ratio: float = 0.1, malformed_files: int = 0, seed: int = 42) -> Dict[str, Any]:
+    """
+    writes a synthetic ics corpus: one calendar per street, each category collected in its interval over the given years.
+    valarm_ratio: share of the events with a VALARM reminder. rrule_ratio: share of the category series written as single
+    recurring event (RRULE) instead of individual events. malformed_files: number of additional broken calendars
+    """
+    rnd = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    start = datetime(datetime.now().year, 1, 1)
+    num_events = 0
+    num_recurring = 0
+    for file_idx in range(files):
+        street = "Strasse " + str(file_idx)
+        lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//waste_collection_benchmark//EN"]
+        for category, (summary, interval) in CORPUS_CATEGORIES.items():
+            first = start + timedelta(days=rnd.randrange(interval))
+            uid = category + "-" + str(file_idx)
+            if rnd.random() < rrule_ratio:
+                lines += ["BEGIN:VEVENT", "UID:" + uid, "DTSTART;VALUE=DATE:" + first.strftime("%Y%m%d"), "SUMMARY:" + summary, "LOCATION:" + street,
+                          "RRULE:FREQ=DAILY;INTERVAL=" + str(interval) + ";UNTIL=" + (start + timedelta(days=365 * years)).strftime("%Y%m%d"), "END:VEVENT"]
+                num_recurring += 1
+                continue
+            date = first
+            while date < start + timedelta(days=365 * years):
+                lines += ["BEGIN:VEVENT", "UID:" + uid + "-" + date.strftime("%Y%m%d"), "DTSTART;VALUE=DATE:" + date.strftime("%Y%m%d"), "SUMMARY:" + summary, "LOCATION:" + street]
+                if rnd.random() < valarm_ratio:
+                    lines += ["BEGIN:VALARM", "ACTION:DISPLAY", "DESCRIPTION:" + summary + " rausstellen", "TRIGGER:-PT12H", "END:VALARM"]
+                lines.append("END:VEVENT")
+                num_events += 1
+                date += timedelta(days=interval)
+        lines.append("END:VCALENDAR")
+        with open(os.path.join(directory, "street_" + str(file_idx) + ".ics"), 'w', encoding='utf-8', newline='') as file:
+            file.write("\r\n".join(lines) + "\r\n")
+    for file_idx in range(malformed_files):
+        # invalid dates, truncated events and binary garbage
+        content = ["BEGIN:VCALENDAR\r\nBEGIN:VEVENT\r\nDTSTART;VALUE=DATE:2024XX01\r\nSUMMARY:Biotonne\r\nEND:VEVENT\r\nEND:VCALENDAR\r\n",
+                   "BEGIN:VCALENDAR\r\nBEGIN:VEVENT\r\nDTSTART;VALUE=DATE:20240101\r\nSUMMARY:Papierto",
+                   "\x00\x01garbage\r\n"][file_idx % 3]
+        with open(os.path.join(directory, "malformed_" + str(file_idx) + ".ics"), 'w', encoding='utf-8', newline='') as file:
+            file.write(content)
+    return {'files': files, 'years': years, 'valarm_ratio': valarm_ratio, 'rrule_ratio': rrule_ratio, 'malformed_files': malformed_files, 'seed': seed,
+            'events': num_events, 'recurring_events': num_recurring}
+
+
+def generate_calendar(filename: str, events: int = 50000, years: int = 10, valarm_ratio: float = 0.5, seed: int = 42) -> Dict[str, Any]:
+    """
+    writes a single large calendar with the given number of events over the given years, e.g. of a whole district:
+    the streets' categories are collected in their intervals until the number of events is reached
+    """
+    rnd = random.Random(seed)
+    start = datetime(datetime.now().year, 1, 1)
+    end = start + timedelta(days=365 * years)
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//waste_collection_benchmark//EN"]
+    num_events = 0
+    street_idx = 0
+    while num_events < events:
+        street = "Strasse " + str(street_idx)
+        for category, (summary, interval) in CORPUS_CATEGORIES.items():
+            date = start + timedelta(days=rnd.randrange(interval))
+            while date < end and num_events < events:
+                lines += ["BEGIN:VEVENT", "UID:" + category + "-" + str(street_idx) + "-" + date.strftime("%Y%m%d"), "DTSTART;VALUE=DATE:" + date.strftime("%Y%m%d"),
+                          "SUMMARY:" + summary, "LOCATION:" + street]
+                if rnd.random() < valarm_ratio:
+                    lines += ["BEGIN:VALARM", "ACTION:DISPLAY", "DESCRIPTION:" + summary + " rausstellen", "TRIGGER:-PT12H", "END:VALARM"]
+                lines.append("END:VEVENT")
+                num_events += 1
+                date += timedelta(days=interval)
+        street_idx += 1
+    lines.append("END:VCALENDAR")
+    with open(filename, 'w', encoding='utf-8', newline='') as file:
+        file.write("\r\n".join(lines) + "\r\n")
+    return {'events': num_events, 'years': years, 'streets': street_idx, 'valarm_ratio': valarm_ratio, 'seed': seed, 'bytes': os.path.getsize(filename)}
+
+
+def measure(func: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    durations = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        durations.append(perf_counter() - start)
+    return {'min_sec': min(durations), 'median_sec': median(durations), 'repeat': repeat}
+
+
+def throughput(func: Callable[[], Any], min_duration_sec: float = 1.0) -> Dict[str, float]:
+    calls = 0
+    start = perf_counter()
+    while True:
+        for _ in range(100):
+            func()
+        calls += 100
+        elapsed = perf_counter() - start
+        if elapsed >= min_duration_sec:
+            return {'ops_per_sec': calls / elapsed, 'calls': calls}
+
+
+def bench_reload(directory: str, repeat: int, strict: bool, parse_workers: int) -> Dict[str, Any]:
+    def cold():
+        schedule = WasteCollectionSchedule(directory, watcher='interval', strict=strict, parse_workers=parse_workers, cache=IcsFileCache())
+        schedule.stop()
+
+    schedule = WasteCollectionSchedule(directory, watcher='interval', strict=strict, parse_workers=parse_workers, cache=IcsFileCache())
+    try:
+        return {'cold_reload': measure(cold, repeat),
+                'warm_reload_verified': measure(lambda: schedule.reload(None), repeat),      # every file is stat'ed
+                'warm_reload_unchanged': measure(lambda: schedule.reload(set()), repeat),    # watcher reported no changes
+                'loaded_collections': len(schedule.snapshot.events)}
+    finally:
+        schedule.stop()
+
+
+def bench_queries(directory: str) -> Dict[str, Any]:
+    schedule = WasteCollectionSchedule(directory, watcher='interval', cache=IcsFileCache())
+    try:
+        now = datetime.now()
+        return {'next_date': throughput(lambda: schedule.next_date('organic', now)),
+                'next_dates': throughput(lambda: schedule.next_dates(now)),
+                'upcoming_collections': throughput(lambda: schedule.upcoming_collections(10, now)),
+                'collections_between_30d': throughput(lambda: schedule.collections_between(now, now + timedelta(days=30)))}
+    finally:
+        schedule.stop()
+
+
+def bench_history_scaling(history_years: Tuple[int, ...] = (1, 10, 30, 50)) -> Dict[str, Any]:
+    # next date lookups of schedules whose collection history grows to decades. The cost should stay flat (binary search)
+    categories = list(CORPUS_CATEGORIES.keys())
+    now = datetime.now()
+    results = {}
+    for years in history_years:
+        events = EventStore()
+        for category, (summary, interval) in CORPUS_CATEGORIES.items():
+            for ordinal in range(now.toordinal() - 365 * years, now.toordinal() + 365, interval):
+                events.add(ordinal, category, summary)
+        snapshot = ScheduleSnapshot(events.sorted_by_day(categories), categories, [], 1)
+        results[str(years) + 'y'] = {'events': len(events),
+                                     'next_date': throughput(lambda: snapshot.next_date('organic', now), 0.5),
+                                     'next_dates': throughput(lambda: snapshot.next_dates(now), 0.5)}
+    return results
+
+
+def bench_webthing(directory: str) -> Dict[str, Any]:
+    try:
+        import tornado.ioloop
+        from waste_collection_webthing import WasteCollectionScheduleThing
+    except ImportError as e:
+        return {'skipped': str(e)}
+    ioloop = tornado.ioloop.IOLoop(make_current=False)
+    schedule = WasteCollectionSchedule(directory, watcher='interval', cache=IcsFileCache())
+    try:
+        async def create():
+            return WasteCollectionScheduleThing("benchmark", schedule)
+        thing = ioloop.run_sync(create)
+        ioloop.run_sync(lambda: asyncio.sleep(0.1))   # initial update of the values
+        return {'property_read': throughput(lambda: thing.get_property('next_organic_reminder')),
+                'properties_read': throughput(thing.get_properties),
+                'reload_and_dispatch': measure(lambda: ioloop.run_sync(lambda: reload_and_dispatch(schedule)), 10),
+                'updates_emitted': thing.updates_emitted,
+                'updates_suppressed': thing.updates_suppressed}
+    finally:
+        schedule.stop()
+        ioloop.close()
+
+
+async def reload_and_dispatch(schedule: WasteCollectionSchedule):
+    schedule.reload(None)
+    await asyncio.sleep(0)   # run the dispatch callback
+
+
+def bench_mcp(directory: str) -> Dict[str, Any]:
+    try:
+        from waste_collection_mcp import WasteCollectionScheduleMCPServer
+    except ImportError as e:
+        return {'skipped': str(e)}
+    schedule = WasteCollectionSchedule(directory, watcher='interval', cache=IcsFileCache())
+    try:
+        server = WasteCollectionScheduleMCPServer("benchmark", 0, schedule=schedule)
+        start = datetime.now().strftime("%Y-%m-%d")
+        end = (datetime.now() + timedelta(days=30)).strftime("%Y-%m-%d")
+        results = {}
+        for tool, arguments in (('get_waste_schedule', {}), ('get_next_collection', {}), ('get_upcoming_collections', {'category': 'paper', 'count': 5}),
+                                ('get_collections_in_range', {'start': start, 'end': end})):
+            results[tool] = asyncio.run(tool_throughput(server, tool, arguments))
+        cache = server.response_caches[None]
+        results['response_cache'] = {'hits': cache.hits, 'misses': cache.misses}
+        return results
+    finally:
+        schedule.stop()
+
+
+async def tool_throughput(server, tool: str, arguments: Dict[str, Any], min_duration_sec: float = 1.0) -> Dict[str, float]:
+    calls = 0
+    start = perf_counter()
+    while perf_counter() - start < min_duration_sec:
+        await server.mcp.call_tool(tool, arguments)
+        calls += 1
+    return {'ops_per_sec': calls / (perf_counter() - start), 'calls': calls}
+
+
+def bench_parsers(filename: str, repeat: int) -> Dict[str, Any]:
+    # the streaming VEVENT reader versus the full parse by the ics library (Calendar)
+    results = {}
+    events = {}
+    for name, strict in (('streaming', False), ('calendar', True)):
+        results[name] = measure(lambda: events.__setitem__(name, list(read_events(filename, strict))), repeat)
+        results[name]['events'] = len(events[name])
+    results['speedup'] = results['calendar']['median_sec'] / results['streaming']['median_sec']
+    results['identical'] = sorted(events['streaming']) == sorted(events['calendar'])
+    return results
+
+
+def compare_parsers(events: int, years: int, valarm_ratio: float, seed: int, repeat: int) -> Dict[str, Any]:
+    calendar_dir = tempfile.mkdtemp(prefix="waste_collection_benchmark_")
+    try:
+        filename = os.path.join(calendar_dir, "district.ics")
+        calendar = generate_calendar(filename, events, years, valarm_ratio, seed)
+        return {'commit': git_commit(),
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'calendar': calendar,
+                'settings': {'repeat': repeat},
+                'results': {'parsers': bench_parsers(filename, repeat)}}
+    finally:
+        shutil.rmtree(calendar_dir, ignore_errors=True)
+
+
+def bench_memory(num_events: int = 100000) -> Dict[str, Any]:
+    # lists of datetime objects (the former representation) versus the event store including summary, location and source
+    categories = list(CORPUS_CATEGORIES.keys())
+    rows = [(datetime(2024, 1, 1).toordinal() + idx // len(categories), categories[idx % len(categories)], "Strasse " + str(idx % 50), "street_" + str(idx % 20) + ".ics")
+            for idx in range(num_events)]
+    tracemalloc.start()
+    try:
+        lists = {category: [] for category in categories}
+        for ordinal, category, _, _ in rows:
+            lists[category].append(datetime.fromordinal(ordinal))
+        lists_bytes = tracemalloc.get_traced_memory()[0]
+        del lists
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        store = EventStore()
+        for ordinal, category, location, source in rows:
+            store.add(ordinal, category, CORPUS_CATEGORIES[category][0], location, source)
+        store_bytes = tracemalloc.get_traced_memory()[0] - base
+    finally:
+        tracemalloc.stop()
+    return {'events': num_events, 'datetime_lists_bytes': lists_bytes, 'event_store_bytes': store_bytes, 'ratio': store_bytes / lists_bytes}
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], path: str = "") -> List[str]:
+    # lists the relative change of each timing (lower is better) and throughput (higher is better) compared to the baseline
+    lines = []
+    for key, value in results.items():
+        if isinstance(value, dict) and isinstance(baseline.get(key), dict):
+            lines += compare(value, baseline[key], path + key + ".")
+        elif key in ('median_sec', 'ops_per_sec') and isinstance(baseline.get(key), (int, float)) and baseline[key] > 0:
+            change = (value - baseline[key]) / baseline[key] * 100
+            better = change < 0 if key == 'median_sec' else change > 0
+            lines.append(path + key + ": " + format(baseline[key], '.6g') + " -> " + format(value, '.6g') + " (" + format(change, '+.1f') + "%" + (", better" if better else ", worse") + ")")
+    return lines
+
+
+def run_benchmarks(directory: Optional[str], files: int, years: int, valarm_ratio: float, rrule_ratio: float, malformed_files: int, seed: int,
+                   repeat: int, strict: bool, parse_workers: int) -> Dict[str, Any]:
+    corpus_dir = tempfile.mkdtemp(prefix="waste_collection_benchmark_") if directory is None else directory
+    try:
+        corpus = {'directory': directory} if directory is not None else generate_corpus(corpus_dir, files, years, valarm_ratio, rrule_ratio, malformed_files, seed)
+        return {'commit': git_commit(),
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'corpus': corpus,
+                'settings': {'repeat': repeat, 'strict': strict, 'parse_workers': parse_workers},
+                'results': {'reload': bench_reload(corpus_dir, repeat, strict, parse_workers),
+                            'queries': bench_queries(corpus_dir),
+                            'history_scaling': bench_history_scaling(),
+                            'webthing': bench_webthing(corpus_dir),
+                            'mcp': bench_mcp(corpus_dir),
+                            'memory': bench_memory()}}
+    finally:
+        if directory is None:
+            shutil.rmtree(corpus_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(name)-20s: %(levelname)-8s %(message)s', level=logging.ERROR, datefmt='%Y-%m-%d %H:%M:%S')
+    parser = argparse.ArgumentParser(description='waste collection benchmarks. The results are written as json')
+    parser.add_argument('--directory', default=None, help='benchmark an existing ics directory instead of a generated corpus')
+    parser.add_argument('--files', type=int, default=20, help='number of generated calendars')
+    parser.add_argument('--years', type=int, default=2, help='years covered by the generated calendars')
+    parser.add_argument('--valarm-ratio', type=float, default=0.5, help='share of the generated events having a VALARM')
+    parser.add_argument('--rrule-ratio', type=float, default=0.1, help='share of the generated category series written as RRULE')
+    parser.add_argument('--malformed', type=int, default=0, help='number of additional malformed calendars')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--repeat', type=int, default=5, help='repetitions of the reload measurements')
+    parser.add_argument('--strict', action='store_true', help='parse with the full ics library')
+    parser.add_argument('--parse-workers', type=int, default=0)
+    parser.add_argument('--output', default=None, help='json file to write the results to (default: stdout)')
+    parser.add_argument('--baseline', default=None, help='json results of a previous run to compare with')
+    parser.add_argument('--generate-only', default=None, metavar='DIRECTORY', help='only write the synthetic corpus to the directory')
+    parser.add_argument('--compare-parsers', action='store_true', help='only compare the streaming reader with the ics library on a single large calendar')
+    parser.add_argument('--parser-events', type=int, default=50000, help='number of events of the calendar compared by --compare-parsers')
+    parser.add_argument('--parser-years', type=int, default=10, help='years covered by the calendar compared by --compare-parsers')
+    args = parser.parse_args()
+
+    if args.generate_only is not None:
+        print(json.dumps(generate_corpus(args.generate_only, args.files, args.years, args.valarm_ratio, args.rrule_ratio, args.malformed, args.seed), indent=2))
+        sys.exit(0)
+    if args.compare_parsers:
+        report = compare_parsers(args.parser_events, args.parser_years, args.valarm_ratio, args.seed, args.repeat)
+    else:
+        report = run_benchmarks(args.directory, args.files, args.years, args.valarm_ratio, args.rrule_ratio, args.malformed, args.seed, args.repeat, args.strict, args.parse_workers)
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+        print("\n".join(compare(report['results'], baseline['results'])), file=sys.stderr)
@@ -0,0 +1,85 @@
+import json
+import logging
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+
+
+DEFAULT_CATEGORIES = {
+    'organic': ['bio'],
+    'recycling': ['wertstoff'],
+    'paper': ['papier'],
+    'residual': ['rest'],
+}
+
+
+class CategoryRegistry:
+    """
+    maps the SUMMARY of an event to a waste category. Categories are checked in the order of registration,
+    the first category owning a matching keyword wins (keywords are matched case-insensitive as substrings)
+    """
+
+    MAX_MEMO_SIZE = 10000
+
+    def __init__(self, categories: Dict[str, List[str]] = None):
+        categories = DEFAULT_CATEGORIES if categories is None else categories
+        self.__matchers: List[Tuple[str, re.Pattern]] = []
+        for name, keywords in categories.items():
+            if len(keywords) > 0:
+                pattern = "|".join(re.escape(keyword) for keyword in keywords)
+                self.__matchers.append((name, re.compile(pattern, re.IGNORECASE)))
+        self.__memo: Dict[str, Optional[str]] = {}
+
+    @property
+    def names(self) -> List[str]:
+        return [name for name, _ in self.__matchers]
+
+    @property
+    def fingerprint(self) -> Tuple[Tuple[str, str], ...]:
+        # registries with equal fingerprints classify equally
+        return tuple((name, matcher.pattern) for name, matcher in self.__matchers)
+
+    def classify(self, summary: str) -> Optional[str]:
+        # returns the category name or None, if the summary does not match any category
+        try:
+            return self.__memo[summary]
+        except KeyError:
+            category = None
+            for name, matcher in self.__matchers:
+                if matcher.search(summary) is not None:
+                    category = name
+                    break
+            if len(self.__memo) >= self.MAX_MEMO_SIZE:
+                self.__memo.clear()
+            self.__memo[summary] = category
+            return category
+
+    def __getstate__(self):
+        # the memo is not shipped to worker processes
+        return {'matchers': self.__matchers}
+
+    def __setstate__(self, state):
+        self.__matchers = state['matchers']
+        self.__memo = {}
+
+    @staticmethod
+    def load(filename: str) -> 'CategoryRegistry':
+        """
+        loads the categories of a json file such as {"organic": ["bio"], "bulky": ["sperrmüll", "sperrmuell"]}
+        """
+        with open(filename, 'r', encoding='utf-8') as file:
+            categories = json.load(file)
+        if not isinstance(categories, dict) or not all(isinstance(keywords, list) for keywords in categories.values()):
+            raise ValueError("invalid category file " + filename + ": expected an object mapping category names to keyword lists")
+        logging.info("categories " + ", ".join(categories.keys()) + " loaded from " + filename)
+        return CategoryRegistry(categories)
+
+    @staticmethod
+    def for_directory(directory: str, filename: Optional[str] = None) -> 'CategoryRegistry':
+        # uses the given file, the categories.json of the directory or the default categories (in this order)
+        if filename is None:
+            filename = os.path.join(directory, 'categories.json')
+            if not os.path.isfile(filename):
+                return CategoryRegistry()
+        return CategoryRegistry.load(filename)
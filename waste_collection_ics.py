@@ -0,0 +1,116 @@
+import re
+from datetime import datetime
+from typing import Iterator, Dict, Tuple, Iterable, Optional
+
+
+
+def unfolded_lines(filename: str) -> Iterator[str]:
+    """
+    streams the content lines of an ics file (RFC 5545 line folding is undone). The file is read buffered line by
+    line, i.e. it is never loaded as a whole. It is not memory-mapped: a file truncated while being read (e.g. overwritten
+    in place by a download) would raise SIGBUS on access of the mapped pages
+    """
+    with open(filename, 'rb') as file:
+        pending = None
+        for raw in file:
+            line = raw.rstrip(b"\r\n")
+            if line[:1] in (b" ", b"\t"):
+                if pending is not None:
+                    pending += line[1:]
+                continue
+            if pending is not None:
+                yield pending.decode('utf-8', errors='replace')
+            pending = line
+        if pending is not None:
+            yield pending.decode('utf-8', errors='replace')
+
+
+def split_content_line(line: str) -> Tuple[str, str, str]:
+    """
+    splits a content line such as DTSTART;VALUE=DATE:20240102 into name, params and value
+    """
+    colon = line.find(':')
+    while colon >= 0 and line.count('"', 0, colon) % 2 == 1:   # colon within a quoted param value
+        colon = line.find(':', colon + 1)
+    if colon < 0:
+        return line.upper(), "", ""
+    head, value = line[:colon], line[colon + 1:]
+    semicolon = head.find(';')
+    if semicolon < 0:
+        return head.upper(), "", value
+    return head[:semicolon].upper(), head[semicolon + 1:], value
+
+
+LIST_PROPERTIES = frozenset(('EXDATE', 'RDATE'))
+
+
+def read_vevents(filename: str, fields: Iterable[str] = ('DTSTART', 'SUMMARY')) -> Iterator[Dict[str, Tuple[str, str]]]:
+    """
+    yields the requested fields of each VEVENT as a dict name -> (params, value). Nested components
+    such as VALARM are skipped while reading
+    """
+    fields = frozenset(fields)
+    depth = 0        # nesting depth within the current VEVENT
+    event = None
+    for line in unfolded_lines(filename):
+        if line[:6].upper() == "BEGIN:":
+            if event is None:
+                if line[6:].strip().upper() == "VEVENT":
+                    event = {}
+                    depth = 1
+            else:
+                depth += 1
+        elif line[:4].upper() == "END:":
+            if event is not None:
+                depth -= 1
+                if depth == 0:
+                    yield event
+                    event = None
+        elif event is not None and depth == 1:
+            name, params, value = split_content_line(line)
+            if name in fields:
+                if name not in event:
+                    event[name] = (params, value)
+                elif name in LIST_PROPERTIES:
+                    # repeated date list property such as EXDATE
+                    prev_params, prev_value = event[name]
+                    event[name] = (prev_params, prev_value + "," + value)
+
+
+ESCAPED = re.compile(r'\\([\\;,nN])')
+
+
+def unescape_text(value: str) -> str:
+    return ESCAPED.sub(lambda match: "\n" if match.group(1) in "nN" else match.group(1), value)
+
+
+def parse_date(value: str) -> datetime:
+    """
+    parses an ics DATE or DATE-TIME value with day granularity
+    """
+    value = value.strip()
+    return datetime(int(value[0:4]), int(value[4:6]), int(value[6:8]))
+
+
+UNTIL_UTC = re.compile(r"(UNTIL=\d{8}(?:T\d{6})?)[Zz]")
+
+
+def naive_value(value: str) -> str:
+    # strips the UTC designator. Timezones are ignored as the schedule works with day granularity
+    return ",".join(part.strip().rstrip("Zz") for part in value.split(","))
+
+
+def recurrence_rule(event: Dict[str, Tuple[str, str]]) -> Optional[str]:
+    """
+    returns the recurrence set (DTSTART, RRULE, RDATE, EXDATE lines) of an event in a form accepted by
+    dateutil's rrulestr or None, if the event is not recurring. All values are made timezone-naive
+    """
+    if 'RRULE' not in event and 'RDATE' not in event:
+        return None
+    lines = ["DTSTART:" + naive_value(event['DTSTART'][1])]
+    if 'RRULE' in event:
+        lines.append("RRULE:" + UNTIL_UTC.sub(r"\1", event['RRULE'][1]))
+    for name in ('RDATE', 'EXDATE'):
+        if name in event:
+            lines.append(name + ":" + naive_value(event[name][1]))
+    return "\n".join(lines)
@@ -1,32 +1,158 @@
-from waste_collection import WasteCollectionSchedule
+import re
+from datetime import datetime
+from threading import Lock
+from typing import Dict, Any, Callable, Hashable
+from waste_collection import WasteCollectionSchedule, ScheduleSnapshot
 from mcplib.server import MCPServer
 
+
+CATEGORY_LABELS = {
+    'recycling': 'Recycling (Gelber Sack)',
+    'organic': 'Bio Waste',
+    'residual': 'Residual Waste (Restmüll)',
+    'paper': 'Paper Waste',
+}
+
+
+def label_of(category: str) -> str:
+    return CATEGORY_LABELS.get(category, category)
+
+
+class ResponseCache:
+    """
+    caches the tool responses of a schedule. The cached responses are dropped if the schedule has been
+    reloaded or a time-dependent value may have changed (day or grace period rollover).
+    A response is computed of the snapshot pinned by the request
+    """
+
+    MAX_SIZE = 1000
+
+    def __init__(self, schedule: WasteCollectionSchedule):
+        self.schedule = schedule
+        self.__lock = Lock()
+        self.__responses: Dict[Hashable, Any] = {}
+        self.__generation = -1
+        self.__valid_until = datetime.min
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, compute: Callable[[ScheduleSnapshot, datetime], Any]) -> Any:
+        with self.__lock:
+            now = datetime.now()
+            snapshot = self.schedule.snapshot
+            if self.__generation != snapshot.generation or now >= self.__valid_until or len(self.__responses) >= self.MAX_SIZE:
+                self.__responses = {}
+                self.__generation = snapshot.generation
+                self.__valid_until = self.schedule.next_rollover(now)
+            if key in self.__responses:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self.__responses[key] = compute(snapshot, now)
+            return self.__responses[key]
+
+
 class WasteCollectionScheduleMCPServer(MCPServer):
     """
     MCP Server that provides information about waste collection dates
     (Recycling, Bio, Residual, and Paper waste).
+    In multi-tenant mode the tools of each schedule are prefixed by the tenant name.
     """
 
-    def __init__(self, name: str, port: int, schedule: WasteCollectionSchedule):
+    def __init__(self, name: str, port: int, schedule: WasteCollectionSchedule = None, schedules: Dict[str, WasteCollectionSchedule] = None):
         super().__init__(name, port)
-        self.schedule = schedule
+        self.schedules = {None: schedule} if schedules is None else schedules
+        self.response_caches = {tenant: ResponseCache(tenant_schedule) for tenant, tenant_schedule in self.schedules.items()}
+        for tenant, tenant_schedule in self.schedules.items():
+            self.__register_tools(tenant, tenant_schedule, self.response_caches[tenant])
+
+    @property
+    def schedule(self) -> WasteCollectionSchedule:
+        return next(iter(self.schedules.values()))
+
+    def __register_tools(self, tenant: str, schedule: WasteCollectionSchedule, cache: ResponseCache):
+        prefix = "" if tenant is None else re.sub(r'[^A-Za-z0-9_]', '_', tenant) + "_"
+        household = "" if tenant is None else " of household " + tenant
+
+        def waste_schedule(snapshot: ScheduleSnapshot, now: datetime) -> str:
+            next_dates = snapshot.next_dates(now)
+            # Using a multiline string for better readability by the AI
+            return (
+                f"Next Waste Collection Dates:\n"
+                f"- Recycling (Gelber Sack): {next_dates['recycling']}\n"
+                f"- Bio Waste: {next_dates['organic']}\n"
+                f"- Residual Waste (Restmüll): {next_dates['residual']}\n"
+                f"- Paper Waste: {next_dates['paper']}"
+            )
+
+        def next_collection(snapshot: ScheduleSnapshot, now: datetime) -> Dict[str, Any]:
+            next_dates = {category: date for category, date in snapshot.next_dates(now).items() if date is not None}
+            if len(next_dates) == 0:
+                return {"summary": "No upcoming waste collection found.", "date": None, "categories": []}
+            date = min(next_dates.values())
+            categories = sorted(category for category, category_date in next_dates.items() if category_date == date)
+            return {"summary": "Next waste collection on " + date.strftime("%Y-%m-%d") + ": " + ", ".join(label_of(category) for category in categories),
+                    "date": date.strftime("%Y-%m-%d"),
+                    "categories": categories}
 
-        @self.mcp.tool(name="get_waste_schedule", description="Returns the next collection dates for all waste types.")
+        def upcoming_collections(snapshot: ScheduleSnapshot, now: datetime, category: str, count: int) -> Dict[str, Any]:
+            if category not in snapshot.timeseries:
+                return {"error": "unknown waste type " + category + " (supported: " + ", ".join(snapshot.timeseries.keys()) + ")"}
+            dates = [date.strftime("%Y-%m-%d") for date in snapshot.upcoming_dates(category, count, now)]
+            return {"summary": "Upcoming " + label_of(category) + " collections: " + (", ".join(dates) if len(dates) > 0 else "none"),
+                    "category": category,
+                    "dates": dates}
+
+        def collections_in_range(snapshot: ScheduleSnapshot, now: datetime, start: str, end: str) -> Dict[str, Any]:
+            start_date, end_date = datetime.strptime(start, "%Y-%m-%d"), datetime.strptime(end, "%Y-%m-%d")
+            collections = [{"date": date.strftime("%Y-%m-%d"), "category": category} for date, category in snapshot.collections_between(start_date, end_date)]
+            lines = ["- " + collection["date"] + ": " + label_of(collection["category"]) for collection in collections]
+            return {"summary": "Waste collections from " + start + " to " + end + ":\n" + ("\n".join(lines) if len(lines) > 0 else "none"),
+                    "start": start,
+                    "end": end,
+                    "collections": collections}
+
+        @self.mcp.tool(name=prefix + "get_waste_schedule", description="Returns the next collection dates for all waste types" + household + ".")
         def get_waste_schedule() -> str:
             """
             Fetches the next scheduled dates for waste pickup.
             Use this to answer questions about when the trash will be collected.
             """
             try:
-                # Using a multiline string for better readability by the AI
-                return (
-                    f"Next Waste Collection Dates:\n"
-                    f"- Recycling (Gelber Sack): {self.schedule.next_recycling}\n"
-                    f"- Bio Waste: {self.schedule.next_organic}\n"
-                    f"- Residual Waste (Restmüll): {self.schedule.next_residual}\n"
-                    f"- Paper Waste: {self.schedule.next_paper}"
-                )
+                return cache.get("get_waste_schedule", waste_schedule)
             except Exception as e:
                 return f"Error retrieving waste schedule: {str(e)}"
 
-# npx @modelcontextprotocol/inspector <path_to_script>
\ No newline at end of file
+        @self.mcp.tool(name=prefix + "get_next_collection", description="Returns the next collection of any waste type" + household + ".")
+        def get_next_collection() -> Dict[str, Any]:
+            """
+            Fetches the date and the waste types of the very next pickup.
+            Use this to answer questions such as "which bin has to be put out next?".
+            """
+            try:
+                return cache.get("get_next_collection", next_collection)
+            except Exception as e:
+                return {"error": f"Error retrieving next collection: {str(e)}"}
+
+        @self.mcp.tool(name=prefix + "get_upcoming_collections", description="Returns the next N collection dates of a waste type (" + ", ".join(schedule.timeseries.keys()) + ")" + household + ".")
+        def get_upcoming_collections(category: str, count: int = 5) -> Dict[str, Any]:
+            """
+            Fetches the upcoming pickup dates of a single waste type.
+            """
+            try:
+                return cache.get(("get_upcoming_collections", category, count), lambda snapshot, now: upcoming_collections(snapshot, now, category, count))
+            except Exception as e:
+                return {"error": f"Error retrieving upcoming collections: {str(e)}"}
+
+        @self.mcp.tool(name=prefix + "get_collections_in_range", description="Returns all collections between start and end date (YYYY-MM-DD, inclusive)" + household + ".")
+        def get_collections_in_range(start: str, end: str) -> Dict[str, Any]:
+            """
+            Fetches the pickups of all waste types within a date range.
+            Use this to answer questions such as "what is collected next week?".
+            """
+            try:
+                return cache.get(("get_collections_in_range", start, end), lambda snapshot, now: collections_in_range(snapshot, now, start, end))
+            except Exception as e:
+                return {"error": f"Error retrieving collections: {str(e)}"}
+
+# npx @modelcontextprotocol/inspector <path_to_script>
@@ -0,0 +1,142 @@
+import io
+from concurrent.futures import Future
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+from typing import Dict, Tuple, List, Callable
+
+
+
+class Histogram:
+
+    BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for idx, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                self.counts[idx] += 1
+                break
+
+
+def format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    return "{" + ",".join(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for name, value in labels) + "}"
+
+
+class Metrics:
+    """
+    collects the metrics of the reload pipeline and renders them in the Prometheus text format
+    """
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__histograms: Dict[str, Dict[Tuple[Tuple[str, str], ...], Histogram]] = {}
+        self.__counters: Dict[str, Dict[Tuple[Tuple[str, str], ...], float]] = {}
+        self.__gauges: Dict[str, Dict[Tuple[Tuple[str, str], ...], float]] = {}
+        self.__help: Dict[str, str] = {}
+
+    def observe(self, name: str, value: float, help: str = "", **labels):
+        with self.__lock:
+            self.__help.setdefault(name, help)
+            self.__histograms.setdefault(name, {}).setdefault(tuple(sorted(labels.items())), Histogram()).observe(value)
+
+    def inc(self, name: str, value: float = 1, help: str = "", **labels):
+        with self.__lock:
+            self.__help.setdefault(name, help)
+            series = self.__counters.setdefault(name, {})
+            key = tuple(sorted(labels.items()))
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, help: str = "", **labels):
+        with self.__lock:
+            self.__help.setdefault(name, help)
+            self.__gauges.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    def remove(self, name: str, **labels):
+        # drops a gauge series, e.g. of a removed file
+        with self.__lock:
+            self.__gauges.get(name, {}).pop(tuple(sorted(labels.items())), None)
+
+    @contextmanager
+    def time_stage(self, stage: str, **labels):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("waste_collection_stage_seconds", perf_counter() - start, "duration of the reload pipeline stages", stage=stage, **labels)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        with self.__lock:
+            for name, series in sorted(self.__histograms.items()):
+                lines.append("# HELP " + name + " " + self.__help.get(name, ""))
+                lines.append("# TYPE " + name + " histogram")
+                for labels, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(Histogram.BUCKETS, histogram.counts):
+                        cumulative += count
+                        lines.append(name + "_bucket" + format_labels(labels + (("le", str(bound)),)) + " " + str(cumulative))
+                    lines.append(name + "_bucket" + format_labels(labels + (("le", "+Inf"),)) + " " + str(histogram.count))
+                    lines.append(name + "_sum" + format_labels(labels) + " " + repr(histogram.sum))
+                    lines.append(name + "_count" + format_labels(labels) + " " + str(histogram.count))
+            for kind, metrics in (("counter", self.__counters), ("gauge", self.__gauges)):
+                for name, series in sorted(metrics.items()):
+                    lines.append("# HELP " + name + " " + self.__help.get(name, ""))
+                    lines.append("# TYPE " + name + " " + kind)
+                    for labels, value in sorted(series.items()):
+                        lines.append(name + format_labels(labels) + " " + repr(float(value)))
+        return "\n".join(lines) + "\n"
+
+
+
+class ReloadProfile:
+    """
+    an on-demand capture (cProfile or tracemalloc) of a single reload. The report is delivered by the future
+    """
+
+    MODES = ('cprofile', 'tracemalloc')
+
+    def __init__(self, mode: str, limit: int = 30):
+        if mode not in self.MODES:
+            raise ValueError("unsupported profile mode " + mode + " (supported: " + ", ".join(self.MODES) + ")")
+        self.mode = mode
+        self.limit = limit
+        self.future: Future = Future()
+
+    def run(self, reload: Callable[[], None]):
+        try:
+            if self.mode == 'cprofile':
+                import cProfile
+                import pstats
+                profiler = cProfile.Profile()
+                profiler.runcall(reload)
+                report = io.StringIO()
+                pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(self.limit)
+                self.future.set_result(report.getvalue())
+            else:
+                import tracemalloc
+                was_tracing = tracemalloc.is_tracing()
+                if not was_tracing:
+                    tracemalloc.start()
+                before = tracemalloc.take_snapshot()
+                reload()
+                after = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+                if not was_tracing:
+                    tracemalloc.stop()
+                lines = ["traced memory: current " + str(current) + " bytes, peak " + str(peak) + " bytes", "top allocations of the reload:"]
+                lines.extend(str(stat) for stat in after.compare_to(before, 'lineno')[:self.limit])
+                self.future.set_result("\n".join(lines) + "\n")
+        except Exception as e:
+            self.future.set_exception(e)
+            raise
+
+
+# shared by all schedules of the process, rendered by the /metrics endpoint
+default_metrics = Metrics()
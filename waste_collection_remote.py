@@ -0,0 +1,219 @@
+import hashlib
+import http.client
+import json
+import logging
+import os
+import re
+import tempfile
+from threading import Lock
+from time import time
+from typing import Dict, List, Set, Tuple, Optional
+from urllib.parse import urlsplit, urljoin
+
+
+
+class HttpClient:
+    """
+    minimal HTTP client keeping one persistent (keep-alive) connection per host
+    """
+
+    MAX_REDIRECTS = 5
+
+    def __init__(self, timeout_sec: float = 30):
+        self.timeout_sec = timeout_sec
+        self.__lock = Lock()
+        self.__connections: Dict[Tuple[str, str], http.client.HTTPConnection] = {}
+
+    def __connection(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        connection = self.__connections.get((scheme, netloc))
+        if connection is None:
+            if scheme == 'https':
+                connection = http.client.HTTPSConnection(netloc, timeout=self.timeout_sec)
+            elif scheme == 'http':
+                connection = http.client.HTTPConnection(netloc, timeout=self.timeout_sec)
+            else:
+                raise ValueError("unsupported url scheme " + scheme)
+            self.__connections[(scheme, netloc)] = connection
+        return connection
+
+    def __discard(self, scheme: str, netloc: str):
+        connection = self.__connections.pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def get(self, url: str, headers: Dict[str, str], target_file: str) -> Tuple[int, Dict[str, str]]:
+        """
+        performs a GET request. On status 200 the body is streamed to the target file. Returns the status
+        and the (lower-cased) response headers
+        """
+        with self.__lock:
+            for _ in range(self.MAX_REDIRECTS + 1):
+                parts = urlsplit(url)
+                path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+                for attempt in range(2):
+                    connection = self.__connection(parts.scheme, parts.netloc)
+                    try:
+                        connection.request('GET', path, headers=headers)
+                        response = connection.getresponse()
+                        break
+                    except (http.client.HTTPException, OSError):
+                        # the server may have closed the idle keep-alive connection. Retry once with a new one
+                        self.__discard(parts.scheme, parts.netloc)
+                        if attempt > 0:
+                            raise
+                response_headers = {name.lower(): value for name, value in response.getheaders()}
+                if response.status in (301, 302, 303, 307, 308) and 'location' in response_headers:
+                    response.read()
+                    url = urljoin(url, response_headers['location'])
+                    continue
+                if response.status == 200:
+                    with open(target_file, 'wb') as file:
+                        for chunk in iter(lambda: response.read(64 * 1024), b""):
+                            file.write(chunk)
+                else:
+                    response.read()
+                if response.will_close:
+                    self.__discard(parts.scheme, parts.netloc)
+                return response.status, response_headers
+            raise IOError("too many redirects fetching " + url)
+
+    def close(self):
+        with self.__lock:
+            for scheme, netloc in list(self.__connections.keys()):
+                self.__discard(scheme, netloc)
+
+
+
+class RemoteSource:
+
+    def __init__(self, name: str, url: str, filename: str):
+        self.name = name
+        self.url = url
+        self.filename = filename           # the local copy of the fetched calendar
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.failures = 0
+        self.next_attempt = 0.0
+
+    @property
+    def meta_filename(self) -> str:
+        return self.filename + ".json"
+
+    def load_meta(self):
+        if os.path.isfile(self.meta_filename) and os.path.isfile(self.filename):
+            with open(self.meta_filename, 'r') as file:
+                meta = json.load(file)
+            if meta.get('url') == self.url:
+                self.etag = meta.get('etag')
+                self.last_modified = meta.get('last_modified')
+
+    def save_meta(self):
+        with open(self.meta_filename, 'w') as file:
+            json.dump({'url': self.url, 'etag': self.etag, 'last_modified': self.last_modified}, file)
+
+
+
+class RemoteSources:
+    """
+    remote ics sources configured by a json file such as {"bio_hauptstrasse": "https://example.org/bio.ics"}.
+    The calendars are fetched using conditional requests (ETag/If-Modified-Since) into local files, which
+    are processed like the local ics files. Unchanged calendars cost a 304 response only
+    """
+
+    BACKOFF_BASE_SEC = 60
+    BACKOFF_MAX_SEC = 6 * 60 * 60
+
+    def __init__(self, sources_file: str, download_dir: str, client: HttpClient = None):
+        self.sources_file = sources_file
+        self.download_dir = download_dir
+        self.client = HttpClient() if client is None else client
+        self.sources: Dict[str, RemoteSource] = {}
+        self.__sources_mtime = None
+        os.makedirs(download_dir, exist_ok=True)
+
+    @staticmethod
+    def for_directory(directory: str, download_root: Optional[str] = None) -> Optional['RemoteSources']:
+        # returns the remote sources of the directory's sources.json or None, if not present
+        sources_file = os.path.join(directory, 'sources.json')
+        if not os.path.isfile(sources_file):
+            return None
+        download_root = os.path.join(tempfile.gettempdir(), 'waste_collection_remote') if download_root is None else download_root
+        download_dir = os.path.join(download_root, hashlib.sha1(os.path.abspath(directory).encode('utf-8')).hexdigest()[:12])
+        return RemoteSources(sources_file, download_dir)
+
+    @property
+    def files(self) -> List[str]:
+        # the local copies of the sources fetched so far
+        return [source.filename for source in self.sources.values() if os.path.isfile(source.filename)]
+
+    def __load_sources(self):
+        mtime = os.stat(self.sources_file).st_mtime_ns
+        if mtime == self.__sources_mtime:
+            return
+        with open(self.sources_file, 'r', encoding='utf-8') as file:
+            urls = json.load(file)
+        if not isinstance(urls, dict):
+            raise ValueError("invalid sources file " + self.sources_file + ": expected an object mapping names to urls")
+        sources = {}
+        for name, url in urls.items():
+            source = self.sources.get(name)
+            if source is None or source.url != url:
+                source = RemoteSource(name, url, os.path.join(self.download_dir, re.sub(r'[^A-Za-z0-9_.-]', '_', name) + ".ics"))
+                source.load_meta()
+            sources[name] = source
+        for name in [name for name in self.sources.keys() if name not in sources]:
+            self.__remove(self.sources[name])
+        self.sources = sources
+        self.__sources_mtime = mtime
+        logging.info(str(len(sources)) + " remote sources loaded from " + self.sources_file)
+
+    def __remove(self, source: RemoteSource):
+        for filename in (source.filename, source.meta_filename):
+            if os.path.isfile(filename):
+                os.remove(filename)
+
+    def refresh(self) -> Set[str]:
+        """
+        fetches the sources which are not in backoff. Returns the local files whose content has changed
+        """
+        self.__load_sources()
+        changed = set()
+        now = time()
+        for source in self.sources.values():
+            if source.next_attempt <= now and self.__fetch(source):
+                changed.add(source.filename)
+        return changed
+
+    def __fetch(self, source: RemoteSource) -> bool:
+        headers = {'User-Agent': 'waste_collection_webthing', 'Accept': 'text/calendar, */*'}
+        if source.etag is not None:
+            headers['If-None-Match'] = source.etag
+        if source.last_modified is not None:
+            headers['If-Modified-Since'] = source.last_modified
+        tmp_file = source.filename + ".tmp"
+        try:
+            status, response_headers = self.client.get(source.url, headers, tmp_file)
+            if status == 304:
+                logging.debug(source.url + " unchanged (304)")
+                changed = False
+            elif status == 200:
+                os.replace(tmp_file, source.filename)
+                source.etag = response_headers.get('etag')
+                source.last_modified = response_headers.get('last-modified')
+                source.save_meta()
+                logging.info(source.url + " fetched")
+                changed = True
+            else:
+                raise IOError("got status " + str(status))
+            source.failures = 0
+            source.next_attempt = 0
+            return changed
+        except Exception as e:
+            source.failures += 1
+            backoff = min(self.BACKOFF_BASE_SEC * 2 ** (source.failures - 1), self.BACKOFF_MAX_SEC)
+            source.next_attempt = time() + backoff
+            logging.warning("error occurred fetching " + source.url + " " + str(e) + " (retry in " + str(backoff) + " sec)")
+            return False
+        finally:
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
@@ -0,0 +1,201 @@
+import logging
+import os
+import select
+import struct
+import ctypes
+from abc import ABC, abstractmethod
+from threading import Thread, Timer, Lock
+from time import sleep
+from typing import Callable, Set, Dict, Tuple, Optional
+
+
+
+class DirectoryWatcher(ABC):
+    """
+    watches a directory for changed ics files. Bursts of changes are debounced, i.e. the listener is called
+    once with the set of affected files after no further change has been seen for debounce_sec. The listener
+    is called with None, if the affected files are unknown (lost events, changes of other names such as a
+    swapped symlinked directory). In this case all files have to be verified
+    """
+
+    def __init__(self, directory: str, listener: Callable[[Optional[Set[str]]], None], debounce_sec: float = 2, suffixes: Tuple[str, ...] = ('.ics',)):
+        self.directory = directory
+        self.debounce_sec = debounce_sec
+        self.suffixes = suffixes
+        self.__listener = listener
+        self.__lock = Lock()
+        self.__changed: Set[str] = set()
+        self.__is_unknown = False
+        self.__timer: Optional[Timer] = None
+        self.is_running = False
+
+    def _on_changed(self, filename: Optional[str]):
+        # filename None: unknown changes
+        with self.__lock:
+            if filename is None or not filename.endswith(self.suffixes):
+                self.__is_unknown = True
+            else:
+                self.__changed.add(os.path.join(self.directory, filename))
+            if self.__timer is not None:
+                self.__timer.cancel()
+            self.__timer = Timer(self.debounce_sec, self.__flush)
+            self.__timer.daemon = True
+            self.__timer.start()
+
+    def __flush(self):
+        with self.__lock:
+            changed = None if self.__is_unknown else self.__changed
+            self.__changed = set()
+            self.__is_unknown = False
+            self.__timer = None
+        if (changed is None or len(changed) > 0) and self.is_running:
+            if changed is None:
+                logging.info("unknown changes detected in " + self.directory + ". Verifying all files")
+            else:
+                logging.info(str(len(changed)) + " changed files detected: " + ", ".join(sorted(changed)))
+            try:
+                self.__listener(changed)
+            except Exception as e:
+                logging.warning("error occurred handling changed files " + str(e))
+
+    def start(self):
+        self.is_running = True
+        Thread(target=self.__run, daemon=True).start()
+
+    def __run(self):
+        try:
+            self._watch_loop()
+        except Exception as e:
+            logging.warning("error occurred watching " + self.directory + " " + str(e) + ". Changes are picked up by the periodic reload only")
+
+    def stop(self):
+        self.is_running = False
+        with self.__lock:
+            if self.__timer is not None:
+                self.__timer.cancel()
+
+    @abstractmethod
+    def _watch_loop(self):
+        pass
+
+
+
+class InotifyWatcher(DirectoryWatcher):
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_CLOEXEC = 0o2000000
+    IN_NONBLOCK = 0o4000
+
+    EVENT_HEADER = struct.Struct("iIII")
+
+    @staticmethod
+    def is_supported() -> bool:
+        # checks that an inotify instance can actually be created (not supported by the platform, instance limit reached, ...)
+        try:
+            libc = InotifyWatcher.__libc()
+            fd = libc.inotify_init1(InotifyWatcher.IN_CLOEXEC | InotifyWatcher.IN_NONBLOCK)
+            if fd < 0:
+                return False
+            os.close(fd)
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def __libc():
+        # the symbols of the running process include the C library, whatever its file name is (glibc, musl on Alpine)
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.inotify_init1   # raises AttributeError on platforms without inotify
+        return libc
+
+    def _watch_loop(self):
+        libc = InotifyWatcher.__libc()
+        fd = libc.inotify_init1(self.IN_CLOEXEC | self.IN_NONBLOCK)
+        if fd < 0:
+            logging.warning("inotify_init1 failed (errno " + str(ctypes.get_errno()) + ")")
+            return
+        try:
+            mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+            if libc.inotify_add_watch(fd, os.fsencode(self.directory), mask) < 0:
+                logging.warning("inotify_add_watch failed for " + self.directory + " (errno " + str(ctypes.get_errno()) + ")")
+                return
+            logging.info("watching " + self.directory + " using inotify")
+            while self.is_running:
+                readable, _, _ = select.select([fd], [], [], 1)
+                if fd in readable:
+                    self.__handle_events(os.read(fd, 64 * 1024))
+        finally:
+            os.close(fd)
+
+    def __handle_events(self, buffer: bytes):
+        offset = 0
+        while offset + self.EVENT_HEADER.size <= len(buffer):
+            _, mask, _, length = self.EVENT_HEADER.unpack_from(buffer, offset)
+            offset += self.EVENT_HEADER.size
+            name = buffer[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                self._on_changed(None)   # events have been lost
+            elif len(name) > 0:
+                self._on_changed(os.fsdecode(name))
+
+
+
+class PollingWatcher(DirectoryWatcher):
+
+    def __init__(self, directory: str, listener: Callable[[Optional[Set[str]]], None], debounce_sec: float = 2, suffixes: Tuple[str, ...] = ('.ics',), poll_interval_sec: float = 10):
+        super().__init__(directory, listener, debounce_sec, suffixes)
+        self.poll_interval_sec = poll_interval_sec
+
+    def __stat_all(self) -> Dict[str, Tuple[int, int]]:
+        stats = {}
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.suffixes):
+                try:
+                    stat = entry.stat()
+                    stats[entry.name] = (stat.st_mtime_ns, stat.st_size)
+                except FileNotFoundError:
+                    pass
+        return stats
+
+    def _watch_loop(self):
+        logging.info("watching " + self.directory + " using stat polling (every " + str(self.poll_interval_sec) + " sec)")
+        known = self.__stat_all()
+        while self.is_running:
+            sleep(self.poll_interval_sec)
+            try:
+                current = self.__stat_all()
+                for name in set(known.keys()) | set(current.keys()):
+                    if known.get(name) != current.get(name):
+                        self._on_changed(name)
+                known = current
+            except Exception as e:
+                logging.warning("error occurred polling " + self.directory + " " + str(e))
+
+
+
+WATCHER_BACKENDS = ('auto', 'inotify', 'poll', 'interval')
+
+
+def create_watcher(backend: str, directory: str, listener: Callable[[Optional[Set[str]]], None], debounce_sec: float = 2) -> Optional[DirectoryWatcher]:
+    """
+    returns the watcher of the given backend or None for the 'interval' backend (periodic full rescan)
+    """
+    if backend == 'interval':
+        return None
+    elif backend == 'poll':
+        return PollingWatcher(directory, listener, debounce_sec)
+    elif backend in ('inotify', 'auto'):
+        if InotifyWatcher.is_supported():
+            return InotifyWatcher(directory, listener, debounce_sec)
+        if backend == 'inotify':
+            logging.warning("inotify is not available. Falling back to stat polling to watch " + directory)
+        return PollingWatcher(directory, listener, debounce_sec)
+    else:
+        raise ValueError("unsupported watcher backend " + backend + " (supported: " + ", ".join(WATCHER_BACKENDS) + ")")
@@ -1,10 +1,21 @@
-import sys
-from datetime import datetime
+import os
+import json
+import socket
+import argparse
+from datetime import datetime, timedelta
+from typing import Tuple, Dict, List
 import logging
+import tornado.gen
 import tornado.ioloop
-from webthing import (SingleThing, Property, Thing, Value, WebThingServer)
-from waste_collection import WasteCollectionSchedule
-from waste_collection_mcp import WasteCollectionScheduleMCPServer
+import tornado.web
+from webthing import (SingleThing, MultipleThings, Property, Thing, Value, WebThingServer)
+from webthing.utils import get_ip
+from zeroconf import ServiceInfo, Zeroconf
+from waste_collection import WasteCollectionSchedule, ScheduleChange, IcsFileCache, ReloadScheduler, AsyncReloadScheduler
+from waste_collection_watcher import WATCHER_BACKENDS
+from waste_collection_categories import CategoryRegistry
+from threading import Thread
+from waste_collection_metrics import Metrics, default_metrics
 
 
 
@@ -41,17 +52,28 @@ class WasteCollectionScheduleThing(Thing):
     # regarding capabilities refer https://iot.mozilla.org/schemas
     # there is also another schema registry http://iotschema.org/docs/full.html not used by webthing
 
-    def __init__(self, description: str, schedule: WasteCollectionSchedule):
+    BUILTIN_CATEGORIES = ('organic', 'recycling', 'paper', 'residual')
+    UPCOMING_DAYS = 30
+
+    def __init__(self, description: str, schedule: WasteCollectionSchedule, tenant: str = None):
         Thing.__init__(
             self,
-            'urn:dev:ops:waste_collection_schedule-1',
-            'WasteCollectionSchedule2',
+            'urn:dev:ops:waste_collection_schedule-1' if tenant is None else 'urn:dev:ops:waste_collection_schedule-' + tenant,
+            'WasteCollectionSchedule2' if tenant is None else 'WasteCollectionSchedule2 ' + tenant,
             ['MultiLevelSensor'],
             description
         )
         self.ioloop = tornado.ioloop.IOLoop.current()
         self.schedule = schedule
-        self.schedule.set_listener(self.on_value_changed)
+        self.updates_emitted = 0
+        self.updates_suppressed = 0
+        self.__computed_day = None   # the day the time-dependent values have been computed for
+        self.__rollover_timeout = None
+        if isinstance(schedule.scheduler, AsyncReloadScheduler):
+            # the changes are awaited on the loop, no need to bounce them from the reload thread
+            self.ioloop.spawn_callback(self.__follow_changes)
+        else:
+            self.schedule.set_listener(self.on_value_changed)
 
         self.next_organic = Value(schedule.next_organic)
         self.add_property(
@@ -89,18 +111,6 @@ class WasteCollectionScheduleThing(Thing):
                          'readOnly': True,
                      }))
 
-        self.next_organic = Value(schedule.next_organic)
-        self.add_property(
-            Property(self,
-                     'next_organic',
-                     self.next_organic,
-                     metadata={
-                         'title': 'next_organic',
-                         "type": "datetime",
-                         'description': 'the datetime of the next organic collection',
-                         'readOnly': True,
-                     }))
-
         self.next_recycling_reminder = Value("")
         self.add_property(
             Property(self,
@@ -201,7 +211,7 @@ class WasteCollectionScheduleThing(Thing):
         self.add_property(
             Property(self,
                      'next_residual',
-                     self.next_organic,
+                     self.next_residual,
                      metadata={
                          'title': 'next_residual',
                          "type": "datetime",
@@ -209,8 +219,28 @@ class WasteCollectionScheduleThing(Thing):
                          'readOnly': True,
                      }))
 
+        # category name -> (date, reminder, soon) values
+        self.category_values = {'organic': (self.next_organic, self.next_organic_reminder, self.next_organic_soon),
+                                'recycling': (self.next_recycling, self.next_recycling_reminder, self.next_recycling_soon),
+                                'paper': (self.next_paper, self.next_paper_reminder, self.next_paper_soon),
+                                'residual': (self.next_residual, self.next_residual_reminder, self.next_residual_soon)}
+        # properties of the additionally configured categories (refer categories.json)
+        for name in [name for name in schedule.categories.names if name not in self.BUILTIN_CATEGORIES]:
+            self.category_values[name] = self.__add_category_properties(name)
 
-        self.scanned_ics_files = Value(",".join(schedule.scanned_ics_files))
+        self.upcoming_collections = Value([])
+        self.add_property(
+            Property(self,
+                     'upcoming_collections',
+                     self.upcoming_collections,
+                     metadata={
+                         'title': 'upcoming_collections',
+                         "type": "array",
+                         'description': 'the collections of all waste types within the next ' + str(self.UPCOMING_DAYS) + ' days',
+                         'readOnly': True,
+                     }))
+
+        self.scanned_ics_files = Value(", ".join(schedule.scanned_ics_files))
         self.add_property(
             Property(self,
                      'scanned_ics_files',
@@ -222,9 +252,67 @@ class WasteCollectionScheduleThing(Thing):
                          'readOnly': True,
                      }))
 
+        # initial update of the (time-dependent) values. Further updates are triggered by reloads and rollovers
+        self.ioloop.add_callback(self.schedule.refresh)
+
+
+    def __add_category_properties(self, name: str) -> Tuple[Value, Value, Value]:
+        date = Value(None)
+        self.add_property(
+            Property(self,
+                     'next_' + name,
+                     date,
+                     metadata={
+                         'title': 'next_' + name,
+                         "type": "datetime",
+                         'description': 'the datetime of the next ' + name + ' collection',
+                         'readOnly': True,
+                     }))
+        reminder = Value("")
+        self.add_property(
+            Property(self,
+                     'next_' + name + '_reminder',
+                     reminder,
+                     metadata={
+                         'title': 'next_' + name + '_reminder',
+                         "type": "string",
+                         'description': 'the next collection message',
+                         'readOnly': True,
+                     }))
+        soon = Value(False)
+        self.add_property(
+            Property(self,
+                     'next_' + name + '_soon',
+                     soon,
+                     metadata={
+                         'title': 'next_' + name + '_soon',
+                         "type": "boolean",
+                         'description': 'true if soon',
+                         'readOnly': True,
+                     }))
+        return date, reminder, soon
+
+    def __schedule_rollover(self):
+        # time-dependent values are recomputed exactly when they may change, instead of waiting for the next reload
+        if self.__rollover_timeout is not None:
+            self.ioloop.remove_timeout(self.__rollover_timeout)
+        delay = (self.schedule.next_rollover() - datetime.now()).total_seconds()
+        self.__rollover_timeout = self.ioloop.call_later(max(delay, 0) + 1, self.__on_rollover)
 
-    def on_value_changed(self):
-        self.ioloop.add_callback(self._on_value_changed)
+    def __on_rollover(self):
+        self.__rollover_timeout = None
+        try:
+            self.schedule.refresh()
+        except Exception as e:
+            logging.warning("error occurred on rollover " + str(e))
+            self.__schedule_rollover()
+
+    def on_value_changed(self, change: ScheduleChange):
+        self.ioloop.add_callback(self._on_value_changed, change)
+
+    async def __follow_changes(self):
+        async for change in self.schedule.subscribe():
+            self._on_value_changed(change)
 
     def __is_soon(self, dt: datetime) -> bool:
         return (dt - day_granularity(datetime.now())).days <= 1
@@ -240,43 +328,242 @@ class WasteCollectionScheduleThing(Thing):
         else:
             return "in " + str(days) + " T."
 
-    def _on_value_changed(self):
+    def __update(self, value: Value, new_value):
+        if new_value == value.get():
+            self.updates_suppressed += 1
+        else:
+            self.updates_emitted += 1
+            value.notify_of_external_update(new_value)
+
+    def _on_value_changed(self, change: ScheduleChange):
+        with self.schedule.metrics.time_stage('dispatch', directory=self.schedule.directory):
+            self.__dispatch(change)
+
+    def __dispatch(self, change: ScheduleChange):
         try:
-            self.next_organic_soon.notify_of_external_update(self.__is_soon(self.schedule.next_organic))
-            self.next_organic.notify_of_external_update(self.schedule.next_organic.strftime("%Y-%m-%d"))
-            self.next_organic_reminder.notify_of_external_update(self.__reminder(self.schedule.next_organic))
+            today = datetime.now().toordinal()
+            # the reminder and soon values depend on the current day. If the day is unchanged, only categories
+            # with a changed next date have to be updated
+            names = self.category_values.keys() if today != self.__computed_day else change.changed_categories
+            for name, (date, reminder, soon) in self.category_values.items():
+                next_date = change.next_dates.get(name)
+                if name in names and next_date is not None:
+                    self.__update(soon, self.__is_soon(next_date))
+                    self.__update(date, next_date.strftime("%Y-%m-%d"))
+                    self.__update(reminder, self.__reminder(next_date))
+                elif name in names:
+                    # no further collection (e.g. the last one has passed), the values are cleared. The
+                    # date is cleared by an empty string, webthing values ignore updates to None
+                    self.__update(soon, False)
+                    self.__update(date, "")
+                    self.__update(reminder, "")
+                else:
+                    self.updates_suppressed += 3
+            self.__computed_day = today
+
+            now = datetime.now()
+            self.__update(self.upcoming_collections, to_json(change.snapshot.collections_between(now, now + timedelta(days=self.UPCOMING_DAYS))))
+
+            if change.files_changed:
+                self.__update(self.scanned_ics_files, ", ".join(change.snapshot.scanned_ics_files))
+            else:
+                self.updates_suppressed += 1
+            self.__schedule_rollover()
+            logging.debug("property updates emitted: " + str(self.updates_emitted) + ", suppressed: " + str(self.updates_suppressed))
+        except Exception as e:
+            self.schedule.metrics.inc("waste_collection_errors_total", 1, "number of errors by reload stage", directory=self.schedule.directory, stage='dispatch')
+            logging.warning("error occurred " + str(e))
 
-            self.next_recycling_soon.notify_of_external_update(self.__is_soon(self.schedule.next_recycling))
-            self.next_recycling.notify_of_external_update(self.schedule.next_recycling.strftime("%Y-%m-%d"))
-            self.next_recycling_reminder.notify_of_external_update(self.__reminder(self.schedule.next_recycling))
 
-            self.next_residual_soon.notify_of_external_update(self.__is_soon(self.schedule.next_residual))
-            self.next_residual.notify_of_external_update(self.schedule.next_residual.strftime("%Y-%m-%d"))
-            self.next_residual_reminder.notify_of_external_update(self.__reminder(self.schedule.next_residual))
+def to_json(collections: List[Tuple[datetime, str]]) -> List[Dict[str, str]]:
+    return [{'date': date.strftime("%Y-%m-%d"), 'category': category} for date, category in collections]
 
-            self.next_paper_soon.notify_of_external_update(self.__is_soon(self.schedule.next_paper))
-            self.next_paper.notify_of_external_update(self.schedule.next_paper.strftime("%Y-%m-%d"))
-            self.next_paper_reminder.notify_of_external_update(self.__reminder(self.schedule.next_paper))
 
-            self.scanned_ics_files.notify_of_external_update(", ".join(self.schedule.scanned_ics_files))
-        except Exception as e:
-            logging.warning("error occurred " + str(e))
+def events_to_json(events: List[Tuple[datetime, str, str, str, str]]) -> List[Dict[str, str]]:
+    return [{'date': date.strftime("%Y-%m-%d"), 'category': category, 'summary': summary, 'location': location, 'source': source}
+            for date, category, summary, location, source in events]
+
+
+class CollectionsHandler(tornado.web.RequestHandler):
+    """
+    range and top-N queries over the collection timeline:
+      GET /collections?from=2024-05-01&to=2024-05-31  collections within the date range (default: the next 30 days)
+      GET /collections?count=10                       the next 10 collections
+    with details=true the summary, location and source file of each collection are included.
+    In multi-tenant mode the tenant has to be selected by the tenant parameter
+    """
+
+    def initialize(self, schedules: Dict[str, WasteCollectionSchedule]):
+        self.schedules = schedules
+
+    def get(self):
+        tenant = self.get_argument('tenant', None)
+        schedule = self.schedules.get(tenant, None)
+        if schedule is None:
+            raise tornado.web.HTTPError(404, "unknown tenant " + str(tenant))
+        snapshot = schedule.snapshot
+        details = self.get_argument('details', 'false').lower() in ('true', '1')
+        try:
+            if self.get_argument('count', None) is not None:
+                count = int(self.get_argument('count'))
+                collections = snapshot.upcoming_events(count) if details else snapshot.upcoming_collections(count)
+            else:
+                start = datetime.strptime(self.get_argument('from'), "%Y-%m-%d") if self.get_argument('from', None) is not None else datetime.now()
+                end = datetime.strptime(self.get_argument('to'), "%Y-%m-%d") if self.get_argument('to', None) is not None else start + timedelta(days=WasteCollectionScheduleThing.UPCOMING_DAYS)
+                collections = snapshot.events_between(start, end) if details else snapshot.collections_between(start, end)
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(events_to_json(collections) if details else to_json(collections)))
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    """
+    GET /health: 200 {"state": "ready"} once every schedule has completed its initial load,
+    503 {"state": "warming"} before. The port is bound before the initial load starts
+    """
+
+    def initialize(self, schedules: Dict[str, WasteCollectionSchedule]):
+        self.schedules = schedules
+
+    def get(self):
+        is_ready = all(schedule.generation > 0 for schedule in self.schedules.values())
+        self.set_status(200 if is_ready else 503)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({'state': 'ready' if is_ready else 'warming'}))
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+    the metrics of the reload pipeline in the Prometheus text format: GET /metrics
+    """
+
+    def initialize(self, metrics: Metrics):
+        self.metrics = metrics
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(self.metrics.render())
+
+
+class ProfileHandler(tornado.web.RequestHandler):
+    """
+    triggers a single reload captured by cProfile or tracemalloc and returns the report:
+      GET /metrics/profile?mode=cprofile     (default)
+      GET /metrics/profile?mode=tracemalloc
+    in multi-tenant mode the tenant has to be selected by the tenant parameter
+    """
+
+    TIMEOUT_SEC = 300
+
+    def initialize(self, schedules: Dict[str, WasteCollectionSchedule]):
+        self.schedules = schedules
+
+    async def get(self):
+        tenant = self.get_argument('tenant', None)
+        schedule = self.schedules.get(tenant, None)
+        if schedule is None:
+            raise tornado.web.HTTPError(404, "unknown tenant " + str(tenant))
+        try:
+            profile = schedule.profile_next_reload(self.get_argument('mode', 'cprofile'))
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        schedule.scheduler.request_reload(schedule, None)
+        try:
+            report = await tornado.gen.with_timeout(timedelta(seconds=self.TIMEOUT_SEC), profile.future)
+        except tornado.gen.TimeoutError:
+            raise tornado.web.HTTPError(504, "profiled reload not completed within " + str(self.TIMEOUT_SEC) + " sec")
+        self.set_header('Content-Type', 'text/plain; charset=utf-8')
+        self.write(report)
 
 
-def run_server(description: str, port: int, directory: str):
-    schedule = WasteCollectionSchedule(directory)
-    server = WebThingServer(SingleThing(WasteCollectionScheduleThing(description, schedule)), port=port, disable_host_validation=True)
-    mcp_server = WasteCollectionScheduleMCPServer("WasteCollectionSchedule", port=port+2, schedule=schedule)
+def scan_tenants(directory: str) -> Dict[str, str]:
+    # every sub directory is a tenant
+    return {name: os.path.join(directory, name) for name in sorted(os.listdir(directory)) if os.path.isdir(os.path.join(directory, name))}
+
+
+class FastStartWebThingServer(WebThingServer):
+    """
+    binds the http port before announcing the server via mDNS. The announcement blocks for some seconds,
+    so it is done in background while the server is already serving
+    """
+
+    def start(self):
+        self.zeroconf = None
+        self.server.listen(self.port)
+        Thread(target=self.__register_service, daemon=True).start()
+        tornado.ioloop.IOLoop.current().start()
+
+    def __register_service(self):
+        try:
+            properties = {'path': '/', 'tls': '1'} if self.app.is_tls else {'path': '/'}
+            self.service_info = ServiceInfo('_webthing._tcp.local.', '{}._webthing._tcp.local.'.format(self.name), addresses=[socket.inet_aton(get_ip())],
+                                            port=self.port, properties=properties, server='{}.local.'.format(socket.gethostname()))
+            zeroconf = Zeroconf()
+            zeroconf.register_service(self.service_info)
+            self.zeroconf = zeroconf
+        except Exception as e:
+            logging.warning("error occurred announcing the server via mDNS " + str(e))
+
+    def stop(self):
+        if self.zeroconf is not None:
+            self.zeroconf.unregister_service(self.service_info)
+            self.zeroconf.close()
+        self.server.stop()
+
+
+def start_mcp_server(port: int, schedules: Dict[str, WasteCollectionSchedule], multi_tenant: bool):
+    # the MCP libraries are slow to import. They are imported on demand, after the http port has been bound
+    from waste_collection_mcp import WasteCollectionScheduleMCPServer
+    if multi_tenant:
+        mcp_server = WasteCollectionScheduleMCPServer("WasteCollectionSchedule", port=port, schedules=schedules)
+    else:
+        mcp_server = WasteCollectionScheduleMCPServer("WasteCollectionSchedule", port=port, schedule=schedules[None])
+    mcp_server.start()
+    return mcp_server
+
+
+def run_server(description: str, port: int, directory: str, watcher: str = 'auto', debounce_sec: float = 2, strict: bool = False, parse_workers: int = 0, parse_executor: str = 'process', categories_file: str = None, multi_tenant: bool = False, snapshot_file: str = None, recurrence_horizon_days: int = 365, use_asyncio: bool = False, mcp: bool = True):
+    # in multi-tenant mode the schedules share the parse cache, the reload thread, the webthing server and the MCP server
+    cache = IcsFileCache(snapshot_file)
+    # use_asyncio: the reloads run as coroutines on the server's IOLoop instead of a reload thread
+    scheduler = AsyncReloadScheduler() if use_asyncio else ReloadScheduler()
+    tenant_directories = scan_tenants(directory) if multi_tenant else {None: directory}
+    # the initial load is done in background after the port has been bound (the server reports "warming" until then).
+    # A restored snapshot is served immediately
+    schedules = {tenant: WasteCollectionSchedule(tenant_directory, watcher=watcher, debounce_sec=debounce_sec, strict=strict, parse_workers=parse_workers, parse_executor=parse_executor,
+                                                 categories=CategoryRegistry.for_directory(tenant_directory, categories_file), cache=cache, scheduler=scheduler,
+                                                 recurrence_horizon_days=recurrence_horizon_days, initial_reload=cache.is_restored)
+                 for tenant, tenant_directory in tenant_directories.items()}
+    if multi_tenant:
+        things = MultipleThings([WasteCollectionScheduleThing(description, schedule, tenant) for tenant, schedule in schedules.items()], 'WasteCollectionSchedules')
+    else:
+        things = SingleThing(WasteCollectionScheduleThing(description, schedules[None]))
+    server = FastStartWebThingServer(things, port=port, disable_host_validation=True, additional_routes=[(r'/collections/?', CollectionsHandler, dict(schedules=schedules)),
+                                                                                          (r'/health/?', HealthHandler, dict(schedules=schedules)),
+                                                                                          (r'/metrics/?', MetricsHandler, dict(metrics=default_metrics)),
+                                                                                          (r'/metrics/profile/?', ProfileHandler, dict(schedules=schedules))])
+    mcp_servers = []
+
+    def start_mcp():
+        try:
+            mcp_servers.append(start_mcp_server(port + 2, schedules, multi_tenant))
+        except Exception as e:
+            logging.warning("error occurred starting the MCP server " + str(e))
 
     try:
-        logging.info('starting the server http://localhost:' + str(port) + " (directory=" + directory + ")")
-        schedule.start()
-        mcp_server.start()
+        logging.info('starting the server http://localhost:' + str(port) + " (directory=" + directory + ", watcher=" + watcher + ", tenants=" + str(len(schedules)) + ")")
+        for schedule in schedules.values():
+            schedule.start()
+        if mcp:
+            Thread(target=start_mcp, daemon=True).start()
         server.start()
     except KeyboardInterrupt:
         logging.info('stopping the server')
-        schedule.stop()
-        mcp_server.stop()
+        for schedule in schedules.values():
+            schedule.stop()
+        for mcp_server in mcp_servers:
+            mcp_server.stop()
         server.stop()
         logging.info('done')
 
@@ -285,7 +572,22 @@ if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s %(name)-20s: %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
     logging.getLogger('tornado.access').setLevel(logging.ERROR)
     logging.getLogger('urllib3.connectionpool').setLevel(logging.WARNING)
-    run_server("description", int(sys.argv[1]), sys.argv[2])
+    parser = argparse.ArgumentParser(description='waste collection webthing')
+    parser.add_argument('port', type=int)
+    parser.add_argument('directory')
+    parser.add_argument('--watcher', choices=WATCHER_BACKENDS, default='auto', help="change detection of the ics files: 'inotify', 'poll' (stat-based), 'auto' (inotify if available, poll otherwise) or 'interval' (full rescan every 27 min)")
+    parser.add_argument('--debounce', type=float, default=2, help='seconds to wait for a burst of file changes to settle before reloading')
+    parser.add_argument('--strict', action='store_true', help='parse the ics files with the full ics library instead of the streaming VEVENT reader')
+    parser.add_argument('--parse-workers', type=int, default=0, help='number of workers to parse changed ics files concurrently (0: sequential)')
+    parser.add_argument('--parse-executor', choices=('process', 'thread'), default='process', help='worker pool type used if --parse-workers > 0')
+    parser.add_argument('--categories', default=None, help='json file mapping waste categories to summary keywords (default: categories.json of the directory, if present)')
+    parser.add_argument('--tenants', action='store_true', help='serve every sub directory of the directory as a separate schedule (thing)')
+    parser.add_argument('--snapshot', default=None, help='file to persist the parsed schedule to. On restart serving starts from the snapshot, which is verified in background')
+    parser.add_argument('--recurrence-horizon', type=int, default=365, help='days (from the start of the current month) up to which recurring events are expanded')
+    parser.add_argument('--asyncio', action='store_true', help='run the reloads on the event loop of the server (only the parse is offloaded to executors) instead of a reload thread')
+    parser.add_argument('--no-mcp', action='store_true', help='do not start the MCP server (port + 2)')
+    args = parser.parse_args()
+    run_server("description", args.port, args.directory, args.watcher, args.debounce, args.strict, args.parse_workers, args.parse_executor, args.categories, args.tenants, args.snapshot, args.recurrence_horizon, args.asyncio, not args.no_mcp)
 
 
 